@@ -15,12 +15,13 @@ http://api.brain-map.org/api/v2/structure_graph_download/1.json
 from __future__ import division
 import sip
 sip.setapi('QString', 2)
-import math, os, PIL, time, zipfile
+import collections, contextlib, itertools, json, math, os, PIL, struct, tempfile, threading, time, zipfile, zlib
+import concurrent.futures
 import cv2, nibabel, nrrd, png, tifffile
 from xml.dom import minidom
 import numpy as np
 import scipy.io, scipy.interpolate, scipy.ndimage
-from PyQt5 import QtWidgets, QtCore
+from PyQt5 import QtWidgets, QtCore, QtGui
 import pyqtgraph as pg
 import matplotlib
 matplotlib.use('qt5agg')
@@ -79,6 +80,7 @@ class ImageGui():
         self.showBinaryState = [False]*self.numWindows
         self.stitchState = [False]*self.numWindows
         self.stitchPos = np.full((self.numWindows,1,3),np.nan)
+        self.stitchOverlayMax = True
         self.holdStitchRange = [False]*self.numWindows
         self.localAdjustHistory = [[] for _ in range(self.numWindows)]
         self.markedPoints = [None]*self.numWindows
@@ -97,10 +99,45 @@ class ImageGui():
         self.contourLineColor = (1,1,0)
         self.atlasTemplate = None
         self.atlasAnnotationData = None
+        self.atlasTransform = None
+        self.atlasLabelIDs = None
+        self.atlasColorLUT = None
+        self.atlasOverlayState = False
+        self.atlasOverlayAlpha = 0.3
         self.atlasAnnotationRegions = None
         self.atlasLineColor = (1,1,1)
         self.selectedAtlasRegions = [[] for _ in range(self.numWindows)]
         self.selectedAtlasRegionIDs = [[] for _ in range(self.numWindows)]
+        self.atlasHemi = 'both'
+        self.projIndexState = False
+        self.pyramidState = True
+        self.cropRenderState = False
+        self.renderedCrop = [None]*self.numWindows
+        self.atlasVersion = 0
+        self.atlasContourCache = LRUCache(128*2**20,getSize=lambda contours: 64+sum(c.nbytes for c in contours))
+        self.atlasPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.frameCache = LRUCache(512*2**20)
+        self.frameBuffers = {}
+        self.frameBuffersLock = threading.Lock()
+        self.sharedDataCache = LRUCache(64*2**20)
+        self.sharedDataPending = {}
+        self.sharedDataLock = threading.Lock()
+        self.dirtyWindows = set()
+        self.dragFrameRate = 20
+        self.lastDisplayTime = 0
+        self.displayTimer = QtCore.QTimer()
+        self.displayTimer.setSingleShot(True)
+        self.displayTimer.timeout.connect(self.flushDisplay)
+        self.prefetchCount = 4
+        self.prefetchFutures = {}
+        self.prefetchPool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.histogramPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.histogramFutures = {}
+        self.mainThreadCaller = MainThreadCaller()
+        self.renderPool = concurrent.futures.ThreadPoolExecutor(max_workers=self.numWindows)
+        self.pyramidPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pyramidFutures = {}
+        self.pyramidFuturesLock = threading.Lock()
         
         # main window
         winHeight = 400
@@ -124,7 +161,9 @@ class ImageGui():
         self.fileMenuOpenFiles.triggered.connect(self.openImageFiles)
         self.fileMenuOpenSeries = QtWidgets.QAction('Image Series',self.mainWin)
         self.fileMenuOpenSeries.triggered.connect(self.openImageSeries)
-        self.fileMenuOpen.addActions([self.fileMenuOpenFiles,self.fileMenuOpenSeries])
+        self.fileMenuOpenChunked = QtWidgets.QAction('Chunked Volume (zarr)',self.mainWin)
+        self.fileMenuOpenChunked.triggered.connect(self.openChunkedVolume)
+        self.fileMenuOpen.addActions([self.fileMenuOpenFiles,self.fileMenuOpenSeries,self.fileMenuOpenChunked])
         
         self.fileMenuSave = self.fileMenu.addMenu('Save')
         self.fileMenuSaveDisplay = QtWidgets.QAction('Display',self.mainWin)
@@ -142,7 +181,9 @@ class ImageGui():
         self.fileMenuSaveVolumeNpz.triggered.connect(self.saveVolume)
         self.fileMenuSaveVolumeMat = QtWidgets.QAction('mat',self.mainWin)
         self.fileMenuSaveVolumeMat.triggered.connect(self.saveVolume)
-        self.fileMenuSaveVolume.addActions([self.fileMenuSaveVolumeImages,self.fileMenuSaveVolumeMovie,self.fileMenuSaveVolumeNpz,self.fileMenuSaveVolumeMat])
+        self.fileMenuSaveVolumeChunked = QtWidgets.QAction('Chunked Volume (zarr)',self.mainWin)
+        self.fileMenuSaveVolumeChunked.triggered.connect(self.saveVolume)
+        self.fileMenuSaveVolume.addActions([self.fileMenuSaveVolumeImages,self.fileMenuSaveVolumeMovie,self.fileMenuSaveVolumeNpz,self.fileMenuSaveVolumeMat,self.fileMenuSaveVolumeChunked])
         
         self.fileMenuPlot = QtWidgets.QAction('Plot',self.mainWin)
         self.fileMenuPlot.triggered.connect(self.plotImage)
@@ -155,6 +196,25 @@ class ImageGui():
         self.optionsMenuImportAutoColor = QtWidgets.QAction('Automatically Color Channels During Import',self.mainWin,checkable=True)
         self.optionsMenu.addActions([self.optionsMenuImportLazy,self.optionsMenuImportMemmap,self.optionsMenuImportAutoColor])
         
+        self.optionsMenuFrameCache = QtWidgets.QAction('Set Display Cache Size',self.mainWin)
+        self.optionsMenuFrameCache.triggered.connect(self.setFrameCacheSize)
+        self.optionsMenuDragFrameRate = QtWidgets.QAction('Set Drag Frame Rate',self.mainWin)
+        self.optionsMenuDragFrameRate.triggered.connect(self.setDragFrameRate)
+        self.optionsMenu.addActions([self.optionsMenuFrameCache,self.optionsMenuDragFrameRate])
+        
+        self.optionsMenuProjIndex = QtWidgets.QAction('Index Volumes For Fast Projections',self.mainWin,checkable=True)
+        self.optionsMenuProjIndex.triggered.connect(self.setProjIndexState)
+        self.optionsMenu.addAction(self.optionsMenuProjIndex)
+        
+        self.optionsMenuPyramid = QtWidgets.QAction('Average Downsampled Display',self.mainWin,checkable=True)
+        self.optionsMenuPyramid.setChecked(True)
+        self.optionsMenuPyramid.triggered.connect(self.setPyramidState)
+        self.optionsMenu.addAction(self.optionsMenuPyramid)
+        
+        self.optionsMenuCropRender = QtWidgets.QAction('Render Visible Region Only',self.mainWin,checkable=True)
+        self.optionsMenuCropRender.triggered.connect(self.setCropRenderState)
+        self.optionsMenu.addAction(self.optionsMenuCropRender)
+        
         self.optionsMenuSetColor = self.optionsMenu.addMenu('Set Color')
         self.optionsMenuSetColorView3dLine = QtWidgets.QAction('View 3D Line',self.mainWin)
         self.optionsMenuSetColorView3dLine.triggered.connect(self.setLineColor)
@@ -240,6 +300,11 @@ class ImageGui():
         self.imageMenuRotateLine = QtWidgets.QAction('To Line',self.mainWin)
         self.imageMenuRotateLine.triggered.connect(self.rotateImage)
         self.imageMenuRotate.addActions([self.imageMenuRotate90C,self.imageMenuRotate90CC,self.imageMenuRotateAngle,self.imageMenuRotateLine])
+        self.imageMenuRotate.addSeparator()
+        self.imageMenuRotateOblique = QtWidgets.QAction('Oblique Reslice (Defer Rotation)',self.mainWin,checkable=True)
+        self.imageMenuRotateApply = QtWidgets.QAction('Apply Oblique Rotation',self.mainWin)
+        self.imageMenuRotateApply.triggered.connect(self.applyObliqueRotation)
+        self.imageMenuRotate.addActions([self.imageMenuRotateOblique,self.imageMenuRotateApply])
         
         self.imageMenuSaveOffsets = QtWidgets.QAction('Save Offsets',self.mainWin)
         self.imageMenuSaveOffsets.triggered.connect(self.saveOffsets)
@@ -395,6 +460,14 @@ class ImageGui():
             self.atlasRegionMenu.append(QtWidgets.QAction(region,self.mainWin,checkable=True))
             self.atlasRegionMenu[-1].triggered.connect(self.setAtlasRegions)
         self.atlasMenuSelect.addActions(self.atlasRegionMenu)
+        self.atlasMenuSearch = QtWidgets.QAction('Search Regions...',self.mainWin)
+        self.atlasMenuSearch.triggered.connect(self.searchAtlasRegions)
+        self.atlasMenuSelect.addSeparator()
+        self.atlasMenuSelect.addAction(self.atlasMenuSearch)
+        
+        self.atlasMenuShowAll = QtWidgets.QAction('Show All Regions',self.mainWin,checkable=True)
+        self.atlasMenuShowAll.triggered.connect(self.setAtlasOverlayState)
+        self.atlasMenu.addAction(self.atlasMenuShowAll)
         
         self.atlasMenuClear = QtWidgets.QAction('Clear All',self.mainWin)
         self.atlasMenuClear.triggered.connect(self.clearAtlasRegions)
@@ -412,13 +485,17 @@ class ImageGui():
         
         self.atlasRotateAnnotation = QtWidgets.QAction('Rotate Annotation Data',self.mainWin)
         self.atlasRotateAnnotation.triggered.connect(self.rotateAnnotationData)
+        self.atlasApplyRotation = QtWidgets.QAction('Apply Annotation Rotation',self.mainWin)
+        self.atlasApplyRotation.triggered.connect(self.applyAnnotationRotation)
         self.atlasResetAnnotation = QtWidgets.QAction('Reset Annotation Data',self.mainWin)
         self.atlasResetAnnotation.triggered.connect(self.resetAnnotationData)
         self.atlasMenuNorm = QtWidgets.QAction('Normalize Region Levels',self.mainWin)
         self.atlasMenuNorm.triggered.connect(self.normRegionLevels)
         self.atlasMenuZero = QtWidgets.QAction('Set Zero Outside Region',self.mainWin)
         self.atlasMenuZero.triggered.connect(self.setOutsideRegionZero)
-        self.atlasMenu.addActions([self.atlasRotateAnnotation,self.atlasResetAnnotation,self.atlasMenuNorm,self.atlasMenuZero])
+        self.atlasMenuPrecompute = QtWidgets.QAction('Precompute Region Contours',self.mainWin)
+        self.atlasMenuPrecompute.triggered.connect(self.precomputeAtlasContours)
+        self.atlasMenu.addActions([self.atlasRotateAnnotation,self.atlasApplyRotation,self.atlasResetAnnotation,self.atlasMenuNorm,self.atlasMenuZero,self.atlasMenuPrecompute])
         
         # image windows
         self.imageLayout = pg.GraphicsLayoutWidget()
@@ -427,6 +504,13 @@ class ImageGui():
         self.imageViewBox = [pg.ViewBox(invertY=True,enableMouse=False,enableMenu=False) for _ in range(self.numWindows)]
         self.imageItem = [pg.ImageItem() for _ in range(self.numWindows)]
         self.markPointsPlot = [pg.PlotDataItem(x=[],y=[],symbol='o',symbolBrush=None,pen=None) for _ in range(self.numWindows)]
+        # overlays are children of the image item so they share its position in the view
+        self.atlasLabelItem = [pg.ImageItem() for _ in range(self.numWindows)]
+        self.atlasContourItem = [QtWidgets.QGraphicsPathItem() for _ in range(self.numWindows)]
+        self.contourItem = [QtWidgets.QGraphicsPathItem() for _ in range(self.numWindows)]
+        for imgItem,overlays in zip(self.imageItem,zip(self.atlasLabelItem,self.atlasContourItem,self.contourItem)):
+            for item in overlays:
+                item.setParentItem(imgItem)
         clickCallbacks = (self.window1ClickCallback,self.window2ClickCallback,self.window3ClickCallback,self.window4ClickCallback)
         doubleClickCallbacks = (self.window1DoubleClickCallback,self.window2DoubleClickCallback,self.window3DoubleClickCallback,self.window4DoubleClickCallback)
         for viewBox,imgItem,ptsPlot,click,doubleClick in reversed(tuple(zip(self.imageViewBox,self.imageItem,self.markPointsPlot,clickCallbacks,doubleClickCallbacks))):
@@ -612,9 +696,11 @@ class ImageGui():
         self.levelsPlotItem.setXRange(0,255)
         self.levelsPlot = self.levelsPlotItem.plot(x=[],y=[])
         self.lowLevelLine = pg.InfiniteLine(pos=0,pen='r',movable=True,bounds=(0,254))
+        self.lowLevelLine.sigPositionChanged.connect(self.levelLineDragged)
         self.lowLevelLine.sigPositionChangeFinished.connect(self.lowLevelLineCallback)
         self.levelsPlotItem.addItem(self.lowLevelLine)
         self.highLevelLine = pg.InfiniteLine(pos=255,pen='r',movable=True,bounds=(1,255))
+        self.highLevelLine.sigPositionChanged.connect(self.levelLineDragged)
         self.highLevelLine.sigPositionChangeFinished.connect(self.highLevelLineCallback)
         self.levelsPlotItem.addItem(self.highLevelLine)
         
@@ -748,6 +834,15 @@ class ImageGui():
         self.mainWin.show()
         
     def mainWinCloseCallback(self,event):
+        self.displayTimer.stop()
+        for future in self.prefetchFutures.values():
+            future.cancel()
+        self.prefetchPool.shutdown(wait=False)
+        self.renderPool.shutdown(wait=False)
+        self.histogramPool.shutdown(wait=False)
+        self.pyramidPool.shutdown(wait=False)
+        self.atlasPool.shutdown(wait=False)
+        tiffPagePool.closeAll()
         event.accept()
         
     def setLineColor(self):
@@ -765,8 +860,41 @@ class ImageGui():
             self.plotMarkedPoints(self.displayedWindows)
         elif sender is self.optionsMenuSetColorContours:
             self.contourLineColor = color
+            for item in self.contourItem:
+                item.setPen(pg.mkPen([255*c for c in color]))
+                if item.brush().style()!=QtCore.Qt.NoBrush:
+                    item.setBrush(pg.mkBrush([255*c for c in color]))
         elif sender is self.optionsMenuSetColorAtlas:
             self.atlasLineColor = color
+            self.updateAtlasOverlay()
+            
+    def setFrameCacheSize(self):
+        size,ok = QtWidgets.QInputDialog.getInt(self.mainWin,'Set Display Cache Size','MB:',self.frameCache.maxBytes//2**20,min=0)
+        if ok:
+            self.frameCache.setMaxBytes(size*2**20)
+            
+    def setDragFrameRate(self):
+        val,ok = QtWidgets.QInputDialog.getInt(self.mainWin,'Set Drag Frame Rate','Frames per second (0 = no limit):',self.dragFrameRate,min=0)
+        if ok:
+            self.dragFrameRate = val
+            
+    def setProjIndexState(self):
+        self.projIndexState = self.optionsMenuProjIndex.isChecked()
+        if not self.projIndexState:
+            for imageObj in self.imageObjs:
+                imageObj.rangeMax = {}
+                
+    def setPyramidState(self):
+        self.pyramidState = self.optionsMenuPyramid.isChecked()
+        if not self.pyramidState:
+            for imageObj in self.imageObjs:
+                imageObj.pyramid = {}
+                imageObj.rangeMax = {key: index for key,index in imageObj.rangeMax.items() if key[1]==1}
+        self.displayImage()
+            
+    def setCropRenderState(self):
+        self.cropRenderState = self.optionsMenuCropRender.isChecked()
+        self.displayImage(self.displayedWindows)
             
     def plotImage(self):
         plt.figure(facecolor='w')
@@ -804,13 +932,39 @@ class ImageGui():
             return
         self.fileSavePath = os.path.dirname(filePath)
         yRange,xRange = [self.imageRange[self.selectedWindow][axis] for axis in self.imageShapeIndex[self.selectedWindow][:2]]
-        image = self.imageItem[self.selectedWindow].image.transpose((1,0,2)) if self.mainWin.sender() is self.fileMenuSaveDisplay else self.getImage()
-        image = image[yRange[0]:yRange[1]+1,xRange[0]:xRange[1]+1]
+        if self.mainWin.sender() is self.fileMenuSaveDisplay:
+            # the displayed image is downsampled and only covers the rendered crop
+            downsample = self.displayDownsample[self.selectedWindow]
+            crop = self.renderedCrop[self.selectedWindow]
+            top,left = (0,0) if crop is None else (crop[0]//downsample,crop[2]//downsample)
+            image = self.compositeOverlays(self.selectedWindow,self.imageItem[self.selectedWindow].image.transpose((1,0,2)))
+            image = image[yRange[0]//downsample-top:yRange[1]//downsample+1-top,xRange[0]//downsample-left:xRange[1]//downsample+1-left]
+        else:
+            image = self.getImage()[yRange[0]:yRange[1]+1,xRange[0]:xRange[1]+1]
         image = image[:,:,0] if self.isGray() else image[:,:,::-1]
         cv2.imwrite(filePath,image)
         
+    def compositeOverlays(self,window,image):
+        # burn the atlas and contour overlays, which are drawn by items on top of the image item, into a copy of the displayed image
+        maxValue = 255 if image.dtype==np.uint8 else self.levelsMax[window]
+        dtype = image.dtype
+        image = image.astype(np.float32,order='C')
+        labelItem = self.atlasLabelItem[window]
+        if labelItem.isVisible() and labelItem.image is not None:
+            overlay = labelItem.image.transpose((1,0,2))[:image.shape[0],:image.shape[1]]
+            h,w = overlay.shape[:2]
+            alpha = overlay[:,:,3:].astype(np.float32)/255
+            image[:h,:w] *= 1-alpha
+            image[:h,:w] += overlay[:,:,:3]*(alpha*maxValue/255)
+        for item in (self.atlasContourItem[window],self.contourItem[window]):
+            drawPathItem(image,item,maxValue)
+        return image.round().astype(dtype)
+        
     def saveVolume(self):
         sender = self.mainWin.sender()
+        if sender==self.fileMenuSaveVolumeChunked:
+            self.saveChunkedVolume()
+            return
         if sender==self.fileMenuSaveVolumeImages:
             fileType = 'Image (*.tif  *.png *.jpg)'
         elif sender==self.fileMenuSaveVolumeMovie:
@@ -858,6 +1012,30 @@ class ImageGui():
             else:
                 scipy.io.savemat(filePath,{'imageData':data},do_compression=True)
     
+    def saveChunkedVolume(self):
+        # raw data of the selected image within the image range of the selected window, written one chunk deep slab at a time
+        if len(self.selectedFileIndex)>1:
+            QtWidgets.QMessageBox.about(self.mainWin,'Warning','Select a single image object to save as a chunked volume')
+            return
+        filePath,fileType = QtWidgets.QFileDialog.getSaveFileName(self.mainWin,'Save As',self.fileSavePath,'*.zarr')
+        if filePath=='':
+            return
+        self.fileSavePath = os.path.dirname(filePath)
+        imageObj = self.imageObjs[self.selectedFileIndex[0]]
+        yRange,xRange,zRange = self.imageRange[self.selectedWindow]
+        shape = (yRange[1]-yRange[0]+1,xRange[1]-xRange[0]+1,zRange[1]-zRange[0]+1,imageObj.shape[3])
+        chunks = (64,64,64,1)
+        progressDialog = QtWidgets.QProgressDialog('Saving...',None,0,shape[2],self.mainWin)
+        progressDialog.setWindowModality(QtCore.Qt.WindowModal)
+        progressDialog.setMinimumDuration(500)
+        def getSlabs():
+            for z in range(zRange[0],zRange[1]+1,chunks[2]):
+                progressDialog.setValue(z-zRange[0])
+                self.app.processEvents()
+                yield imageObj.getData(rangeSlice=slice(z,min(z+chunks[2],zRange[1]+1)))[yRange[0]:yRange[1]+1,xRange[0]:xRange[1]+1]
+        writeChunkedVolume(filePath,getSlabs(),shape,imageObj.dtype,chunks,imageObj.pixelSize)
+        progressDialog.close()
+    
     def isGray(self):            
         for fileInd in self.checkedFileIndex[self.selectedWindow]:
             imageObj = self.imageObjs[fileInd]
@@ -872,6 +1050,14 @@ class ImageGui():
         if len(filePaths)>0:
             self.loadImageFiles(filePaths,fileType)
             
+    def openChunkedVolume(self):
+        dirPath = QtWidgets.QFileDialog.getExistingDirectory(self.mainWin,'Choose Chunked Volume (zarr) Directory',self.fileOpenPath)
+        if dirPath!='':
+            try:
+                self.loadImageFiles([dirPath],'Chunked Volume (*.zarr)')
+            except ValueError as e:
+                QtWidgets.QMessageBox.about(self.mainWin,'Warning',str(e))
+            
     def openImageSeries(self):
         filePaths,fileType = QtWidgets.QFileDialog.getOpenFileNames(self.mainWin,'Choose File(s)',self.fileOpenPath,'Image Series (*.tif *.btf *.png *.jpg *.jp2);;Bruker Dir (*.xml);;Bruker Dir + Siblings (*.xml)',self.fileSeriesType)
         if len(filePaths)>0:
@@ -884,7 +1070,7 @@ class ImageGui():
             self.fileSavePath = self.fileOpenPath
         chFileOrg = None
         numCh = None
-        isMappable = any(True for f in filePaths if os.path.splitext(f)[1] in ('.tif','.btf'))
+        isMappable = any(True for f in filePaths if os.path.splitext(f)[1] in ('.tif','.btf','.npy','.npz'))
         if fileType=='Image Series (*.tif *.btf *.png *.jpg *.jp2)':
             filePaths = [filePaths]
             chFileOrg,ok = QtWidgets.QInputDialog.getItem(self.mainWin,'Import Image Series','Channel file organization:',('rgb','alternating','blocks'))
@@ -962,6 +1148,9 @@ class ImageGui():
         self.selectedAtlasRegions[window] = []
         self.displayedWindows.remove(window)
         self.imageItem[window].setImage(np.zeros((2,2,3),dtype=np.uint8),levels=[0,255])
+        self.atlasLabelItem[window].setVisible(False)
+        for item in (self.atlasContourItem[window],self.contourItem[window]):
+            item.setPath(QtGui.QPainterPath())
         self.imageViewBox[window].setMouseEnabled(x=False,y=False)
         self.imageViewBox[window].setZValue(0)
         self.clearMarkedPoints([window])
@@ -1022,14 +1211,10 @@ class ImageGui():
         fileInd = set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex)
         if len(fileInd)>0:
             isSet = False
-            if self.showVolumeLevelsButton.isChecked():
-                pixIntensityHist = np.zeros(self.levelsMax[self.selectedWindow]+1)
             for i in fileInd:
                 channels = [self.viewChannelsSelectedCh] if self.viewChannelsCheckbox.isChecked() else self.selectedChannels[self.selectedWindow]
                 channels = [ch for ch in channels if ch<self.imageObjs[i].shape[3]]
                 if len(channels)>0:
-                    if self.showVolumeLevelsButton.isChecked():
-                        pixIntensityHist += np.histogram(self.imageObjs[i].getData(channels),np.arange(self.levelsMax[self.selectedWindow]+2))[0]
                     if not isSet:
                         levels = self.imageObjs[i].levels[channels[0]]
                         self.lowLevelLine.setValue(levels[0])
@@ -1040,7 +1225,7 @@ class ImageGui():
                         self.alphaBox.setValue(self.imageObjs[i].alpha)
                         isSet = True
             if self.showVolumeLevelsButton.isChecked():
-                self.updateLevelsPlot(pixIntensityHist)
+                self.displayVolumeHistogram()
         else:
             self.lowLevelLine.setValue(0)
             self.highLevelLine.setValue(self.levelsMax[self.selectedWindow])
@@ -1052,6 +1237,37 @@ class ImageGui():
         for box in self.levelsBoxes:
             box.blockSignals(False)             
                 
+    def displayVolumeHistogram(self):
+        # sum of cached channel histograms of the selected files
+        # histograms that have not been computed are built on a worker thread and the plot is updated when they are ready
+        pixIntensityHist = np.zeros(self.levelsMax[self.selectedWindow]+1)
+        isReady = True
+        channels = [self.viewChannelsSelectedCh] if self.viewChannelsCheckbox.isChecked() else self.selectedChannels[self.selectedWindow]
+        for i in set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex):
+            imageObj = self.imageObjs[i]
+            for ch in channels:
+                if ch<imageObj.shape[3]:
+                    hist = imageObj.histograms.get(ch)
+                    if hist is None:
+                        isReady = False
+                        self.computeHistogram(imageObj,ch)
+                    else:
+                        n = min(hist.size,pixIntensityHist.size)
+                        pixIntensityHist[:n] += hist[:n]
+        self.updateLevelsPlot(pixIntensityHist if isReady else None)
+        
+    def computeHistogram(self,imageObj,ch):
+        key = (id(imageObj),ch)
+        if key not in self.histogramFutures:
+            future = self.histogramPool.submit(imageObj.computeHistogram,ch)
+            self.histogramFutures[key] = future
+            future.add_done_callback(lambda f: self.mainThreadCaller.sig.emit(lambda: self.histogramReady(key,f)))
+            
+    def histogramReady(self,key,future):
+        del self.histogramFutures[key]
+        if future.exception() is None and self.showVolumeLevelsButton.isChecked():
+            self.displayVolumeHistogram()
+            
     def updateLevelsPlot(self,pixIntensityHist=None):
         if pixIntensityHist is None:
             self.levelsPlot.setData(x=[],y=[])
@@ -1151,6 +1367,7 @@ class ImageGui():
                     scaledData[:,:,i,ch] = cv2.resize(next(dataIter),shape[1::-1],interpolation=interpMethod)
             self.imageObjs[fileInd].data = scaledData
             self.imageObjs[fileInd].shape = shape
+            self.imageObjs[fileInd].dataModified()
         windows = self.getAffectedWindows()
         for window in windows:
             self.imageShape[window] = self.imageObjs[self.checkedFileIndex[window][0]].shape[:3]
@@ -1193,7 +1410,13 @@ class ImageGui():
             for fileInd in self.selectedFileIndex:
                 self.imageObjs[fileInd].rotate90(direction,axes[:2])
         else:
+            # the rotation is computed on copies of the data and points and only kept if it is not cancelled
             pts = self.markedPoints[self.selectedWindow]
+            newPts = None if pts is None else pts.copy()
+            imageObjs = [self.imageObjs[fileInd] for fileInd in self.selectedFileIndex if self.imageObjs[fileInd].sourceData is not None]
+            checkedObj = self.imageObjs[self.checkedFileIndex[self.selectedWindow][0]]
+            checkedShape = checkedObj.shape[:3]
+            zSlice = slice(None)
             if sender is self.imageMenuRotateAngle:
                 angle,ok = QtWidgets.QInputDialog.getDouble(self.mainWin,'Rotation Angle','degrees:',0,decimals=2)
                 if not ok or angle==0:
@@ -1212,36 +1435,53 @@ class ImageGui():
                 # only use portion of image volume containing points
                 pointsLength = ((z.max()-z.min())**2+(y.max()-y.min())**2)**0.5
                 pad = int(pointsLength*math.tan(zangle))
-                smax = max(self.imageObjs[fileInd].shape[axes[2]] for fileInd in self.selectedFileIndex)
+                smax = max(imageObj.shape[axes[2]] for imageObj in imageObjs)
                 pad = (min(z.min(),-pad+5),5) if pad<0 else (5,min(smax-z.max(),pad+5))
-                for fileInd in self.selectedFileIndex:
-                    self.imageObjs[fileInd].data = self.imageObjs[fileInd].data[:,:,int(z.min()-pad[0]):int(math.ceil(z.max())+pad[1]+1)]
-                    self.imageObjs[fileInd].shape = self.imageObjs[fileInd].data.shape
-                self.markedPoints[self.selectedWindow][:,2] -= z.min()-pad[0]
+                zSlice = slice(int(z.min()-pad[0]),int(math.ceil(z.max())+pad[1]+1))
+                newPts[:,2] -= z.min()-pad[0]
+                if checkedObj in imageObjs:
+                    checkedShape = checkedObj.shape[:2]+(len(range(*zSlice.indices(checkedShape[2]))),)
+            rotations = []
             for i,(angle,ax) in enumerate(zip(self.rotationAngle,self.rotationAxes)):
                 if angle!=0:
                     if 0 in ax:
-                        angle *= -1
                         self.rotationAngle[i] *= -1
-                    s = self.imageObjs[self.checkedFileIndex[self.selectedWindow][0]].shape[:3]
-                    center = [(s[i]-1)/2 for i in ax]
-                    for fileInd in self.selectedFileIndex:
-                        self.imageObjs[fileInd].rotate(angle,ax)
-                    if pts is not None:
-                        # translate points such that origin is center of rotation , rotate, then translate back to image origin
-                        # ynew = -x*sin(a) + y*cos(a)
-                        # xnew = x*cos(a) + y*sin(a)
-                        a = math.radians(angle)
-                        if 0 not in ax:
-                            a *= -1
-                        p = pts[:,ax]-center
-                        s = self.imageObjs[self.checkedFileIndex[self.selectedWindow][0]].shape[:3]
-                        c = [(s[i]-1)/2 for i in ax]
-                        pts[:,ax[0]] = -p[:,1]*math.sin(a)+p[:,0]*math.cos(a)+c[0]
-                        pts[:,ax[1]] = np.mean(p[:,1]*math.cos(a)+p[:,0]*math.sin(a)+c[1])
-                        imgInd = int(round(pts[0,ax[1]]))
-                        self.imageIndex[self.selectedWindow][ax[1]] = imgInd
-                        self.imageNumEditBoxes[ax[1]].setText(str(imgInd+1))
+                    rotations.append((self.rotationAngle[i],ax))
+            oblique = self.imageMenuRotateOblique.isChecked()
+            if oblique:
+                rotatedData = None
+            else:
+                progressDialog = QtWidgets.QProgressDialog('Rotating...','Cancel',0,100,self.mainWin)
+                progressDialog.setWindowModality(QtCore.Qt.WindowModal)
+                progressDialog.setMinimumDuration(500)
+                def progress(fraction):
+                    progressDialog.setValue(int(100*fraction))
+                    self.app.processEvents()
+                    return not progressDialog.wasCanceled()
+                rotatedData = rotateVolumes([imageObj.data[:,:,zSlice] for imageObj in imageObjs],rotations,[imageObj.memmap for imageObj in imageObjs],progress)
+                progressDialog.close()
+                if rotatedData is None:
+                    return
+            for n,imageObj in enumerate(imageObjs):
+                if oblique:
+                    if zSlice!=slice(None):
+                        imageObj.data = imageObj.data[:,:,zSlice]
+                        imageObj.shape = imageObj.data.shape
+                        imageObj.dataModified()
+                    for angle,ax in rotations:
+                        imageObj.setObliqueRotation(angle,ax)
+                else:
+                    imageObj.data = rotatedData[n]
+                    imageObj.shape = imageObj.data.shape
+                    imageObj.dataModified()
+            if pts is not None:
+                for angle,ax in rotations:
+                    outShape = getRotationTransform(checkedShape,angle,ax)[2] if checkedObj in imageObjs else checkedShape
+                    imgInd = rotatePoints(newPts,angle,ax,checkedShape,outShape)
+                    checkedShape = outShape
+                    self.imageIndex[self.selectedWindow][ax[1]] = imgInd
+                    self.imageNumEditBoxes[ax[1]].setText(str(imgInd+1))
+                self.markedPoints[self.selectedWindow] = newPts
             if len(self.selectedAtlasRegions[self.selectedWindow])>0:
                 self.rotateAnnotationData()
             if pts is not None:
@@ -1260,6 +1500,21 @@ class ImageGui():
             self.setViewBoxRange(affectedWindows)
         self.displayImage(affectedWindows)
         
+    def applyObliqueRotation(self):
+        progressDialog = QtWidgets.QProgressDialog('Rotating...','Cancel',0,100,self.mainWin)
+        progressDialog.setWindowModality(QtCore.Qt.WindowModal)
+        progressDialog.setMinimumDuration(500)
+        # progress is reported over all selected files
+        def progress(fraction,n=0):
+            progressDialog.setValue(int(100*(n+fraction)/len(self.selectedFileIndex)))
+            self.app.processEvents()
+            return not progressDialog.wasCanceled()
+        for n,fileInd in enumerate(self.selectedFileIndex):
+            if not self.imageObjs[fileInd].applyObliqueRotation(lambda fraction,n=n: progress(fraction,n)):
+                break
+        progressDialog.close()
+        self.displayImage(self.getAffectedWindows())
+        
     def saveOffsets(self):
         if len(self.selectedFileIndex)>1:
             QtWidgets.QMessageBox.about(self.mainWin,'Warning','Select a single image object to return its offsets')
@@ -1326,6 +1581,7 @@ class ImageGui():
                     adjustedData[:,:,i,ch] = data if scaleFactor==1 else cv2.resize(data,shape[1::-1],interpolation=interpMethod)
             self.imageObjs[fileInd].data = adjustedData
             self.imageObjs[fileInd].shape = shape
+            self.imageObjs[fileInd].dataModified()
         if scaleFactor!=1:
             self.imageShape[self.selectedWindow] = shape[:3]
             self.setImageRange()
@@ -1381,6 +1637,7 @@ class ImageGui():
                     warpData[:,:,ind,ch] = cv2.warpAffine(next(dataIter),self.transformMatrix[ind],self.transformShape[1::-1],flags=cv2.INTER_LINEAR)
             self.imageObjs[fileInd].data = warpData
             self.imageObjs[fileInd].shape = warpData.shape
+            self.imageObjs[fileInd].dataModified()
         if sender is self.imageMenuTransformAligned:
             for ind,window in enumerate((refWin,self.selectedWindow)):
                 self.sliceProjState[window] = sliceProjState[ind]
@@ -1441,6 +1698,7 @@ class ImageGui():
                         for ch in range(imageData.shape[3]):
                             warpData = cv2.warpAffine(imageData[warpSlice[0],warpSlice[1],ind,ch],warpMatrix,refRect[2:],flags=cv2.INTER_LINEAR,borderMode=cv2.BORDER_REFLECT_101)
                             self.imageObjs[fileInd].data[refSlice[0],refSlice[1],imgInd,ch][mask] = warpData[mask]
+            self.imageObjs[fileInd].dataModified()
         self.displayImage()
     
     def makeCCFVolume(self):
@@ -1466,6 +1724,7 @@ class ImageGui():
                         ccfData[:,:,ind] = data[:,:,i]
             self.imageObjs[fileInd].data = ccfData
             self.imageObjs[fileInd].shape = ccfData.shape
+            self.imageObjs[fileInd].dataModified()
         self.imageIndex[self.selectedWindow][2] = np.where(self.alignIndex[self.selectedWindow]==rng[0])[0][0]
         self.alignRefWindow[self.selectedWindow] = None
         self.alignCheckbox.setChecked(False)
@@ -1563,72 +1822,256 @@ class ImageGui():
             windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
             for window in windows:
                 self.displayDownsample[window] = val
-                self.setViewBoxRangeLimits(windows)
-                self.setViewBoxRange(windows)
-                self.displayImage(windows)
+            self.setViewBoxRangeLimits(windows)
+            self.setViewBoxRange(windows)
+            self.scheduleDisplay(windows)
+        
+    def scheduleDisplay(self,windows=None,throttle=False):
+        # mark windows for display and render them once when control returns to the event loop
+        # throttle limits the display rate to dragFrameRate (while dragging level or slice lines)
+        self.dirtyWindows.update([self.selectedWindow] if windows is None else windows)
+        delay = 0
+        if throttle and self.dragFrameRate>0:
+            delay = max(0,int(1000*(1/self.dragFrameRate-(time.perf_counter()-self.lastDisplayTime))))
+        if not self.displayTimer.isActive():
+            self.displayTimer.start(delay)
+            
+    def flushDisplay(self):
+        windows = [window for window in self.displayedWindows if window in self.dirtyWindows]
+        self.dirtyWindows.clear()
+        self.lastDisplayTime = time.perf_counter()
+        if len(windows)>0:
+            self.displayImage(windows)
         
     def displayImage(self,windows=None):
         if windows is None:
             windows = [self.selectedWindow]
+        # windows that are not cached are rendered concurrently; images are applied to the display on this thread
+        frames = []
         for window in windows:
-            image = self.getImage(window,downsample=self.displayDownsample[window])
+            downsample = self.displayDownsample[window]
+            crop = self.getDisplayCrop(window,downsample)
+            frameKey = self.getFrameKey(window,downsample,crop=crop)
+            image = self.frameCache.get(frameKey)
+            if image is None and frameKey in self.prefetchFutures and not self.prefetchFutures[frameKey].cancelled():
+                image = self.prefetchFutures[frameKey].result()
+            if image is None:
+                if len(windows)>1:
+                    image = self.renderPool.submit(self.renderImage,window,downsample,crop,frameKey)
+                else:
+                    image = self.renderImage(window,downsample,crop,frameKey)
+            frames.append((window,downsample,crop,image))
+        for window,downsample,crop,image in frames:
+            if isinstance(image,concurrent.futures.Future):
+                image = image.result()
             levels = [0,255] if image.dtype==np.uint8 else [0,self.levelsMax[window]]
-            self.imageItem[window].setImage(image.transpose((1,0,2)),levels=levels)
+            self.setImageItem(window,image,levels,crop,downsample)
             if self.showImageLevelsButton.isChecked() and window is self.selectedWindow:
-                self.updateLevelsPlot(np.histogram(image,np.arange(self.levelsMax[window]+2))[0])
+                self.updateLevelsPlot(np.bincount(image.ravel(),minlength=self.levelsMax[window]+1)[:self.levelsMax[window]+1])
+            self.contourItem[window].setPath(QtGui.QPainterPath())
+        self.updateAtlasOverlay(windows)
         self.plotMarkedPoints(windows)
         
-    def getImage(self,window=None,downsample=1,binary=False,atlas=True):
+    def renderImage(self,window,downsample,crop,frameKey):
+        image = self.getImage(window,downsample=downsample,atlas=False,crop=crop)
+        self.frameCache.put(frameKey,image)
+        return image
+        
+    def setImageItem(self,window,image,levels,crop=None,downsample=1):
+        # position the image item at the top left corner of the rendered region
+        self.renderedCrop[window] = crop
+        self.imageItem[window].setImage(image.transpose((1,0,2)),levels=levels)
+        self.imageItem[window].setPos(*((0,0) if crop is None else (crop[2]//downsample,crop[0]//downsample)))
+        
+    def getDisplayCrop(self,window,downsample):
+        # visible part of the image plane plus a margin of half the view size on each side; None if this is the whole plane
+        if not self.cropRenderState:
+            return None
+        crop = []
+        for axis in self.imageShapeIndex[window][:2]:
+            rng = self.imageRange[window][axis]
+            margin = (rng[1]-rng[0]+1)//2
+            start = max(0,rng[0]-margin)
+            crop += [start-start%downsample,min(self.imageShape[window][axis],rng[1]+1+margin)]
+        if crop[0]==0 and crop[2]==0 and all(crop[i]==self.imageShape[window][axis] for i,axis in zip((1,3),self.imageShapeIndex[window][:2])):
+            return None
+        return tuple(crop)
+        
+    def isImageRangeRendered(self,window):
+        crop = self.renderedCrop[window]
+        if crop is None:
+            return True
+        return all(crop[i]<=self.imageRange[window][axis][0] and self.imageRange[window][axis][1]<crop[i+1] for i,axis in zip((0,2),self.imageShapeIndex[window][:2]))
+        
+    def prefetchImages(self,windows,axis,step):
+        # render the next slices in the direction of travel on worker threads so they are already in the frame cache
+        frameKeys = []
+        if step!=0:
+            for window in windows:
+                if self.sliceProjState[window] or self.imageShapeIndex[window][2]!=axis:
+                    continue
+                downsample = self.displayDownsample[window]
+                crop = self.getDisplayCrop(window,downsample)
+                rng = self.imageRange[window][axis]
+                for n in range(1,self.prefetchCount+1):
+                    imgInd = self.imageIndex[window][axis]+n*step
+                    if not rng[0]<=imgInd<=rng[1]:
+                        break
+                    frameKey = self.getFrameKey(window,downsample,imageIndex=imgInd,crop=crop)
+                    frameKeys.append(frameKey)
+                    if frameKey not in self.prefetchFutures and self.frameCache.get(frameKey) is None:
+                        self.prefetchFutures[frameKey] = self.prefetchPool.submit(self.prefetchImage,window,downsample,imgInd,crop,frameKey)
+        for frameKey in list(self.prefetchFutures.keys()):
+            if frameKey not in frameKeys:
+                self.prefetchFutures.pop(frameKey).cancel()
+                
+    def prefetchImage(self,window,downsample,imageIndex,crop,frameKey):
+        image = self.getImage(window,downsample=downsample,atlas=False,imageIndex=imageIndex,crop=crop)
+        # discard if display state changed while rendering
+        if self.getFrameKey(window,downsample,imageIndex=imageIndex,crop=crop)!=frameKey:
+            return None
+        self.frameCache.put(frameKey,image)
+        return image
+        
+    def getFrameKey(self,window,downsample,binary=False,imageIndex=None,crop=None):
+        # everything that getImage output without atlas overlays depends on; data edits change the key through ImageObj.dataVersion
+        axis = self.imageShapeIndex[window][2]
+        if self.sliceProjState[window]:
+            ind = tuple(self.imageRange[window][axis])
+        else:
+            ind = self.imageIndex[window][axis] if imageIndex is None else imageIndex
+        files = []
+        for fileInd in self.checkedFileIndex[window]:
+            imageObj = self.imageObjs[fileInd]
+            channels = tuple(ch for ch in self.selectedChannels[window] if ch<imageObj.shape[3])
+            display = tuple((tuple(imageObj.levels[ch]),imageObj.gamma[ch],imageObj.rgbInd[ch]) for ch in channels)
+            stitchPos = tuple(self.stitchPos[window,fileInd]) if self.stitchState[window] else None
+            files.append((imageObj.dataVersion,channels,display,imageObj.alpha,stitchPos))
+        stitch = self.stitchOverlayMax if self.stitchState[window] else None
+        return (window,tuple(self.imageShape[window]),self.imageShapeIndex[window],self.sliceProjState[window],ind,downsample,self.pyramidState,crop,
+                tuple(files),stitch,self.levelsMax[window],self.normState[window],binary or self.showBinaryState[window])
+        
+    def getSharedImageData(self,key,func,*args):
+        # compute func(*args) once for concurrent requests with the same key; the result is also kept in a small cache
+        with self.sharedDataLock:
+            data = self.sharedDataCache.get(key)
+            if data is not None:
+                return data
+            future = self.sharedDataPending.get(key)
+            isOwner = future is None
+            if isOwner:
+                future = concurrent.futures.Future()
+                self.sharedDataPending[key] = future
+        if not isOwner:
+            return future.result()
+        try:
+            data = np.ascontiguousarray(func(*args))
+            self.sharedDataCache.put(key,data)
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.sharedDataLock:
+                del self.sharedDataPending[key]
+        return data
+        
+    def getFrameBuffer(self,window,name,shape):
+        # float32 compositing buffers reused across frames; each rendering thread keeps its few most recently used buffers
+        key = (name,shape)
+        with self.frameBuffersLock:
+            buffers = self.frameBuffers.setdefault(threading.get_ident(),collections.OrderedDict())
+            buf = buffers.pop(key,None)
+            if buf is None:
+                buf = np.empty(shape,dtype=np.float32)
+            buffers[key] = buf
+            while len(buffers)>4:
+                buffers.popitem(last=False)
+        return buf
+        
+    def getImage(self,window=None,downsample=1,binary=False,atlas=True,imageIndex=None,crop=None):
+        # imageIndex overrides the displayed slice index (used for rendering off the gui thread)
+        # crop = (top,bottom,left,right) renders only that part of the plane (full resolution pixels, top and left multiples of downsample)
         if window is None:
             window = self.selectedWindow
         if self.showBinaryState[window]:
             binary = True
-        imageShape = [int(math.ceil(self.imageShape[window][i]/downsample)) for i in self.imageShapeIndex[window][:2]]
-        image = np.zeros((imageShape[0],imageShape[1],3))
+        shapeIndex = self.imageShapeIndex[window][:2]
+        if crop is None:
+            crop = (0,self.imageShape[window][shapeIndex[0]],0,self.imageShape[window][shapeIndex[1]])
+        imageShape = [int(math.ceil(crop[1]/downsample))-crop[0]//downsample,int(math.ceil(crop[3]/downsample))-crop[2]//downsample]
+        image = self.getFrameBuffer(window,'image',(imageShape[0],imageShape[1],3))
+        image.fill(0)
         for fileInd in self.checkedFileIndex[window]:
             imageObj = self.imageObjs[fileInd]
-            if self.stitchState[window]:
-                i,j = (slice(int(self.stitchPos[window,fileInd,i]//downsample),int(self.stitchPos[window,fileInd,i]+math.ceil(imageObj.shape[i])/downsample)) for i in self.imageShapeIndex[window][:2])
-            else:
-                i,j = (slice(0,int(math.ceil(imageObj.shape[i]/downsample))) for i in self.imageShapeIndex[window][:2])
+            pos = [int(self.stitchPos[window,fileInd,i]) for i in shapeIndex] if self.stitchState[window] else [0,0]
+            region = []
+            for start,stop,p,i in zip(crop[::2],crop[1::2],pos,shapeIndex):
+                start = max(0,start//downsample-p//downsample)*downsample
+                stop = min(imageObj.shape[i],(int(math.ceil(stop/downsample))-p//downsample)*downsample)
+                region.append(slice(start,stop))
+            if any(r.start>=r.stop for r in region):
+                continue
             channels = [ch for ch in self.selectedChannels[window] if ch<imageObj.shape[3]]
-            data,alphaMap = self.getImageData(imageObj,fileInd,window,channels,downsample,binary)
+            data,alphaMap = self.getImageData(imageObj,fileInd,window,channels,downsample,binary,imageIndex,region)
             if data is not None:
+                (i,si),(j,sj) = (getPasteSlices(p//downsample+r.start//downsample-c//downsample,n,size) for p,r,c,n,size in zip(pos,region,crop[::2],data.shape,imageShape))
+                data = data[si,sj]
+                # blend in place; data is weighted by alpha into a reused scratch buffer
+                weight = None
+                if alphaMap is not None:
+                    alphaMap = alphaMap[si,sj]
+                    weight = alphaMap[:,:,0]*imageObj.alpha if imageObj.alpha<1 else alphaMap[:,:,0]
+                elif imageObj.alpha<1:
+                    weight = imageObj.alpha
                 if not self.stitchState[window]:
                     if alphaMap is not None:
-                        image *= 1-alphaMap
+                        image[i,j] *= 1-alphaMap
                     if imageObj.alpha<1:
                         image *= 1-imageObj.alpha
+                if weight is not None:
+                    scratch = self.getFrameBuffer(window,'scratch',tuple(imageShape))[:data.shape[0],:data.shape[1]]
                 for ind,ch in enumerate(channels):
+                    chData = data[:,:,ind]
+                    if weight is not None:
+                        chData = np.multiply(chData,weight,out=scratch)
                     for k in imageObj.rgbInd[ch]:
-                        if self.stitchState[window] and self.imageMenuStitchOverlayMax.isChecked():
-                            image[i,j,k] = np.maximum(image[i,j,k],data[:,:,ind],out=image[i,j,k])
-                        elif imageObj.alpha<1 or alphaMap is not None:
-                            image[i,j,k] += data[:,:,ind]
+                        if self.stitchState[window] and self.stitchOverlayMax:
+                            np.maximum(image[i,j,k],chData,out=image[i,j,k])
+                        elif weight is not None:
+                            np.add(image[i,j,k],chData,out=image[i,j,k])
                         else:
-                            image[i,j,k] = data[:,:,ind]
+                            image[i,j,k] = chData
         if self.normState[window]:
             levels = (image.min(),image.max())
             image.clip(levels[0],levels[1],out=image)
             image -= levels[0] 
             image /= (levels[1]-levels[0])/self.levelsMax[window]
+        if atlas and self.atlasOverlayState and not binary:
+            overlay = self.getAtlasLabelImage(window,downsample,imageIndex,crop)[:image.shape[0],:image.shape[1]]
+            h,w = overlay.shape[:2]
+            alpha = overlay[:,:,3:].astype(np.float32)/255
+            image[:h,:w] *= 1-alpha
+            image[:h,:w] += overlay[:,:,:3]*(alpha*self.levelsMax[window]/255)
         dtype = np.uint8 if self.levelsMax[window]==255 or binary else np.uint16
         image = image.astype(dtype)
         if atlas and len(self.selectedAtlasRegions[window])>0:
             color = tuple(self.levelsMax[window]*c for c in self.atlasLineColor)
             for regionID in self.selectedAtlasRegionIDs[window]:
-                contours = self.getAtlasRegionContours(window,regionID,downsample)
+                contours = self.getAtlasRegionContours(window,regionID,downsample,imageIndex,crop)
                 cv2.drawContours(image,contours,-1,color,1,cv2.LINE_AA)
         return image
                     
-    def getImageData(self,imageObj,fileInd,window,channels,downsample,binary):
+    def getImageData(self,imageObj,fileInd,window,channels,downsample,binary,imageIndex=None,region=None):
+        # region = (row slice,column slice) of the image plane in imageObj pixels
+        # returns display values and alpha map (if any); alpha weighting is applied by getImage
         isProj = self.sliceProjState[window]
         axis = self.imageShapeIndex[window][2]
         if isProj:
             rng = (0,imageObj.shape[axis]-1) if self.stitchState[window] else self.imageRange[window][axis]
             rangeSlice = slice(rng[0],rng[1]+1)
         else:
-            i = self.imageIndex[window][axis]
+            i = self.imageIndex[window][axis] if imageIndex is None else imageIndex
             if i<0:
                 return None,None
             if self.stitchState[window]:
@@ -1636,63 +2079,128 @@ class ImageGui():
                 if not 0<=i<imageObj.shape[axis]:
                     return None,None
             rangeSlice = slice(i,i+1)
-        if imageObj.data is None:
-            data = np.zeros([imageObj.shape[i] for i in self.imageShapeIndex[window][:2]]+[len(channels)],dtype=imageObj.dtype)
-            zSlice = rangeSlice if axis==2 else slice(0,imageObj.shape[2])
+        if region is None:
+            region = [slice(0,imageObj.shape[i]) for i in self.imageShapeIndex[window][:2]]
+        rows,cols = region
+        index = [None]*3
+        for i,s in zip(self.imageShapeIndex[window],(rows,cols,rangeSlice)):
+            index[i] = s
+        # windows showing other channels of the same view share one read of all their channels
+        rawChannels = channels
+        if len(self.displayedWindows)>1:
+            rawChannels = sorted(set(channels) | set(ch for w in self.displayedWindows if fileInd in self.checkedFileIndex[w] for ch in self.selectedChannels[w] if ch<imageObj.shape[3]))
+            key = (imageObj.dataVersion,axis,isProj,rangeSlice.start,rangeSlice.stop,rows.start,rows.stop,cols.start,cols.stop,downsample,self.pyramidState,tuple(rawChannels))
+            data = self.getSharedImageData(key,self.getRawImageData,imageObj,axis,isProj,rawChannels,downsample,index)
+        else:
+            data = self.getRawImageData(imageObj,axis,isProj,rawChannels,downsample,index)
+        # map raw intensities to display values through cached per channel lookup tables
+        dtype = np.uint8 if self.levelsMax[window]==255 or binary else np.uint16
+        lutData = np.empty(data.shape[:2]+(len(channels),),dtype=dtype)
+        for chInd,ch in enumerate(channels):
+            np.take(imageObj.getLUT(ch,self.levelsMax[window],binary),data[:,:,rawChannels.index(ch)],out=lutData[:,:,chInd],mode='clip')
+        data = lutData
+        if imageObj.alphaMap is None:
+            alphaMap = None
+        else:
+            alphaMap = imageObj.alphaMap[tuple(index)]
+            if axis==0:
+                alphaMap = alphaMap.transpose((0,2,1))
+            alphaMap = alphaMap.max(axis)[::downsample,::downsample,None].astype(np.float32)
+            alphaMap /= self.levelsMax[window]
+        return data,alphaMap
+        
+    def getRawImageData(self,imageObj,axis,isProj,channels,downsample,index):
+        # image plane (or max projection) of raw intensities; index = slices of imageObj for each spatial axis
+        shapeIndex = [i for i in range(3) if i!=axis]
+        if axis==0:
+            shapeIndex.reverse()
+        shapeIndex.append(axis)
+        rows,cols,rangeSlice = (index[i] for i in shapeIndex)
+        stride = downsample
+        if imageObj.sourceData is None and imageObj.fileType=='chunked':
+            # read only the chunks intersecting the plane (or projection range) from the resolution level closest to downsample
+            level = imageObj.volume.getLevel(downsample) if self.pyramidState else 0
+            factor = 2**level
+            stride = downsample//factor
+            levelIndex = [slice(s.start//factor,max(s.start//factor+1,int(math.ceil(s.stop/factor)))) for s in index]
+            chRange = slice(min(channels),max(channels)+1)
+            data = imageObj.formatData(imageObj.volume.read(level,tuple(levelIndex)+(chRange,))[:,:,:,[ch-chRange.start for ch in channels]])
+            if axis==0:
+                data = data.transpose((0,2,1,3))
+            data = data.max(axis)
+        elif imageObj.sourceData is None and imageObj.fileType=='tiffPyramid':
+            # read only the tiles intersecting the displayed region from the resolution level closest to downsample
+            pyramid = imageObj.tiffPyramid
+            level = pyramid.getLevel(downsample) if self.pyramidState else 0
+            factor = pyramid.factors[level]
+            stride = downsample//factor
+            levelRows,levelCols = [slice(s.start//factor,max(s.start//factor+1,int(math.ceil(s.stop/factor)))) for s in index[:2]]
+            data = pyramid.read(level,levelRows,levelCols,channels)[:,:,None,:]
+            if axis==0:
+                data = data.transpose((0,2,1,3))
+            data = data.max(axis)
+        elif imageObj.sourceData is None:
+            data = np.zeros((rows.stop-rows.start,cols.stop-cols.start,len(channels)),dtype=imageObj.dtype)
+            zSlice = index[2]
             dataIter = imageObj.getDataIterator(channels,zSlice)
             for i in range(zSlice.start,zSlice.stop):
                 for chInd,_ in enumerate(channels):
                     d = next(dataIter)
                     if axis==2:
                         chData = data[:,:,chInd]
+                        d = d[rows,cols]
                     elif axis==1:
-                        chData = data[:,i,chInd]
-                        d = d[:,rangeSlice].max(axis=1)
+                        chData = data[:,i-zSlice.start,chInd]
+                        d = d[rows,rangeSlice].max(axis=1)
                     else:
-                        chData = data[i,:,chInd]
-                        d = d[rangeSlice,:].max(axis=0)
+                        chData = data[i-zSlice.start,:,chInd]
+                        d = d[rangeSlice,cols].max(axis=0)
                     chData = np.maximum(d,chData,out=chData)
+        elif imageObj.obliqueTransform is not None:
+            # sample only the displayed plane (or projection range) of the rotated volume
+            index = [slice(s.start,s.stop,stride) if i in shapeIndex[:2] else s for i,s in enumerate(index)]
+            data = imageObj.getObliqueData(tuple(index),channels,axis)
+            if axis==0:
+                data = data.transpose((1,0,2))
+            stride = 1
         else:
-            if axis==2:
-                data = imageObj.data[:,:,rangeSlice,channels]
-            elif axis==1:
-                data = imageObj.data[:,rangeSlice,:,channels]
+            # read from the averaged pyramid level closest to downsample and stride the remainder
+            factor = imageObj.getPyramidFactor(downsample) if self.pyramidState else 1
+            if not imageObj.isPyramidLevelReady(axis,factor):
+                # the level is built in the background; until then the full resolution data are strided
+                self.buildPyramidLevel(imageObj,axis,factor)
+                factor = 1
+            stride = downsample//factor
+            levelIndex = [s if i==axis else slice(s.start//factor,int(math.ceil(s.stop/factor))) for i,s in enumerate(index)]
+            if isProj and self.projIndexState:
+                data = imageObj.getRangeMax(axis,rangeSlice,channels,factor,tuple(s for i,s in enumerate(levelIndex) if i!=axis))
+                if axis==0:
+                    data = data.transpose((1,0,2))
             else:
-                data = imageObj.data[rangeSlice,:,:,channels].transpose((0,2,1,3))
-            data = data.max(axis)
-        data = data[::downsample,::downsample].astype(float)
-        for chInd,ch in enumerate(channels):
-            chData = data[:,:,chInd]
-            if binary:
-                aboveThresh = chData>=imageObj.levels[ch][1]
-                chData[aboveThresh] = 255
-                chData[~aboveThresh] = 0
-            else:
-                levels = imageObj.levels[ch]
-                if levels[0]>0 or levels[1]<self.levelsMax[window]:
-                    chData.clip(levels[0],levels[1],out=chData)
-                    chData -= imageObj.levels[ch][0] 
-                    chData /= (levels[1]-levels[0])/self.levelsMax[window]
-                if imageObj.gamma[ch]!=1:
-                    chData /= self.levelsMax[window]
-                    chData **= imageObj.gamma[ch]
-                    chData *= self.levelsMax[window]
-        if imageObj.alphaMap is None:
-            alphaMap = None
-        else:
-            if axis==2:
-                alphaMap = imageObj.alphaMap[:,:,rangeSlice]
-            elif axis==1:
-                alphaMap = imageObj.alphaMap[:,rangeSlice,:]
-            else:
-                alphaMap = imageObj.alphaMap[rangeSlice,:,:].transpose((0,2,1))
-            alphaMap = (alphaMap.max(axis).astype(float)/self.levelsMax[window])[:,:,None]
-            data *= alphaMap
-        if imageObj.alpha<1:
-            data *= imageObj.alpha
-        return data,alphaMap
-        
-    def getAtlasRegionContours(self,window,regionID,downsample=1):
+                data = imageObj.getPyramidLevel(axis,factor)[tuple(levelIndex)+(channels,)]
+                if axis==0:
+                    data = data.transpose((0,2,1,3))
+                data = data.max(axis)
+        return data[::stride,::stride]
+        
+    def buildPyramidLevel(self,imageObj,axis,factor):
+        # levels are built on their own pool so that displayImage never waits for them; also called from render and prefetch threads
+        key = (id(imageObj),axis,factor)
+        with self.pyramidFuturesLock:
+            if key in self.pyramidFutures:
+                return
+            future = self.pyramidPool.submit(imageObj.getPyramidLevel,axis,factor)
+            self.pyramidFutures[key] = future
+        future.add_done_callback(lambda f: self.mainThreadCaller.sig.emit(lambda: self.pyramidLevelReady(key,f)))
+            
+    def pyramidLevelReady(self,key,future):
+        # the level changed ImageObj.dataVersion, so frames strided from full resolution data are rendered again
+        with self.pyramidFuturesLock:
+            self.pyramidFutures.pop(key,None)
+        if future.exception() is None:
+            self.displayImage(self.displayedWindows)
+        
+    def getAtlasRegionContours(self,window,regionID,downsample=1,imageIndex=None,crop=None):
         isProj = self.sliceProjState[window]
         axis = self.imageShapeIndex[window][2]
         if isProj:
@@ -1701,26 +2209,123 @@ class ImageGui():
                 rng = [self.getAlignedRefImageIndex(window,i) for i in rng]
             ind = slice(rng[0],rng[1]+1)
         else:
-            ind = self.imageIndex[window][axis]
+            ind = self.imageIndex[window][axis] if imageIndex is None else imageIndex
             if self.alignRefWindow[window] is not None:
                 ind = self.getAlignedRefImageIndex(window,ind)
-        if axis==2:
-            a = self.atlasAnnotationData[:,:,ind]
-        elif axis==1:
-            a = self.atlasAnnotationData[:,ind,:]
-        else:
-            a = self.atlasAnnotationData.transpose((0,2,1))[ind,:,:]
-        mask = np.in1d(a,regionID).reshape(a.shape)
+        key = (self.atlasVersion,tuple(regionID),axis,(ind.start,ind.stop) if isProj else int(ind),downsample,self.atlasHemi,crop)
+        contours = self.atlasContourCache.get(key)
+        if contours is not None:
+            return contours
+        # downsample and crop labels before masking; one pixel margin so regions are not closed at the crop edge
+        h,w = self.getAtlasPlaneShape(axis)
+        if crop is None:
+            crop = (0,h,0,w)
+        top,left = (max(0,c-downsample) for c in crop[::2])
+        rows,cols = slice(top,crop[1]+downsample,downsample),slice(left,crop[3]+downsample,downsample)
+        lut = self.getAtlasRegionLUT(regionID)
         if isProj:
-            mask = mask.max(axis=axis)
-        mask = mask[::downsample,::downsample]
-        if self.atlasMenuHemiLeft.isChecked():
-            mask[:,mask.shape[1]//2:] = 0
-        elif self.atlasMenuHemiRight.isChecked():
-            mask[:,:mask.shape[1]//2] = 0
-        contours,_ = cv2.findContours(mask.copy(order='C').astype(np.uint8),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+            # one annotation plane at a time so that a pending rotation is never sampled for the whole range at once
+            mask = None
+            for i in range(*ind.indices(self.getAtlasShape()[axis])):
+                planeMask = lut[self.getAtlasAnnotation(axis,i,rows,cols)]
+                mask = planeMask if mask is None else np.maximum(mask,planeMask,out=mask)
+        else:
+            mask = lut[self.getAtlasAnnotation(axis,ind,rows,cols)]
+        mid = max(0,int(math.ceil(w/downsample))//2-left//downsample)
+        if self.atlasHemi=='left':
+            mask[:,mid:] = 0
+        elif self.atlasHemi=='right':
+            mask[:,:mid] = 0
+        offset = ((left-crop[2])//downsample,(top-crop[0])//downsample)
+        contours,_ = cv2.findContours(mask.copy(order='C').astype(np.uint8),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE,offset=offset)
+        self.atlasContourCache.put(key,contours)
         return contours
         
+    def precomputeAtlasContours(self):
+        # fill the contour cache for every slice in the image range of the selected window in the background
+        # contours are cached by crop, so they are computed for the currently rendered crop
+        window = self.selectedWindow
+        if len(self.selectedAtlasRegions[window])>0 and not self.sliceProjState[window]:
+            axis = self.imageShapeIndex[window][2]
+            rng = self.imageRange[window][axis]
+            self.atlasPool.submit(self.precomputeAtlasContoursWorker,window,axis,range(rng[0],rng[1]+1),self.displayDownsample[window],self.renderedCrop[window],list(self.selectedAtlasRegionIDs[window]),self.atlasVersion)
+            
+    def precomputeAtlasContoursWorker(self,window,axis,imageIndex,downsample,crop,regionIDs,atlasVersion):
+        for i in imageIndex:
+            # stop if the view or annotation changed
+            if self.imageShapeIndex[window][2]!=axis or self.displayDownsample[window]!=downsample or self.renderedCrop[window]!=crop or self.sliceProjState[window] or self.atlasVersion!=atlasVersion:
+                return
+            for regionID in regionIDs:
+                self.getAtlasRegionContours(window,regionID,downsample,i,crop)
+        
+    def getAtlasLabelImage(self,window,downsample=1,imageIndex=None,crop=None):
+        # rgba image of every annotated region filled with its atlas color and all region boundaries
+        axis = self.imageShapeIndex[window][2]
+        if self.sliceProjState[window]:
+            # labels at the middle of the projection range
+            ind = sum(self.imageRange[window][axis])//2
+        else:
+            ind = self.imageIndex[window][axis] if imageIndex is None else imageIndex
+        if self.alignRefWindow[window] is not None:
+            ind = self.getAlignedRefImageIndex(window,ind)
+        h,w = self.getAtlasPlaneShape(axis)
+        if crop is None:
+            crop = (0,h,0,w)
+        # one sample margin so that boundaries at the crop edge are found
+        top,left = (max(0,c-downsample) for c in crop[::2])
+        labels = np.array(self.getAtlasAnnotation(axis,ind,slice(top,crop[1]+downsample,downsample),slice(left,crop[3]+downsample,downsample)))
+        mid = max(0,int(math.ceil(w/downsample))//2-left//downsample)
+        if self.atlasHemi=='left':
+            labels[:,mid:] = 0
+        elif self.atlasHemi=='right':
+            labels[:,:mid] = 0
+        boundary = np.zeros(labels.shape,dtype=bool)
+        boundary[1:] = labels[1:]!=labels[:-1]
+        boundary[:,1:] |= labels[:,1:]!=labels[:,:-1]
+        i,j = ((c-start)//downsample for c,start in zip(crop[::2],(top,left)))
+        n,m = (int(math.ceil((crop[k+1]-crop[k])/downsample)) for k in (0,2))
+        image = self.getAtlasColorLUT()[labels[i:i+n,j:j+m]]
+        image[boundary[i:i+n,j:j+m]] = [255*c for c in self.atlasLineColor]+[255]
+        return image
+        
+    def getAtlasColorLUT(self):
+        # rgba color for each index of atlasAnnotationData; background and unknown ids are transparent
+        if self.atlasColorLUT is None or len(self.atlasColorLUT)!=len(self.atlasLabelIDs):
+            structures = self.atlasAnnotationRegions.structures
+            self.atlasColorLUT = np.zeros((len(self.atlasLabelIDs),4),dtype=np.uint8)
+            for i,structureID in enumerate(self.atlasLabelIDs):
+                if structureID!=0 and structureID in structures:
+                    c = structures[structureID]['color']
+                    self.atlasColorLUT[i] = [int(c[k:k+2],16) for k in (0,2,4)]+[int(255*self.atlasOverlayAlpha)]
+        return self.atlasColorLUT
+        
+    def updateAtlasOverlay(self,windows=None):
+        # atlas overlays are drawn by items on top of the image so they do not require rendering the image again
+        if windows is None:
+            windows = self.displayedWindows
+        for window in windows:
+            downsample = self.displayDownsample[window]
+            crop = self.renderedCrop[window]
+            show = self.atlasAnnotationData is not None and self.atlasAnnotationRegions is not None
+            if show and self.atlasOverlayState:
+                self.atlasLabelItem[window].setImage(self.getAtlasLabelImage(window,downsample,crop=crop).transpose((1,0,2)),levels=[0,255])
+                self.atlasLabelItem[window].setVisible(True)
+            else:
+                self.atlasLabelItem[window].setVisible(False)
+            contours = []
+            if show and len(self.selectedAtlasRegions[window])>0:
+                for regionID in self.selectedAtlasRegionIDs[window]:
+                    contours += self.getAtlasRegionContours(window,regionID,downsample,crop=crop)
+            self.atlasContourItem[window].setPath(getContourPath(contours))
+            self.atlasContourItem[window].setPen(pg.mkPen([255*c for c in self.atlasLineColor]))
+        
+    def setAtlasOverlayState(self):
+        if self.atlasMenuShowAll.isChecked() and not self.loadAtlasData():
+            self.atlasMenuShowAll.setChecked(False)
+            return
+        self.atlasOverlayState = self.atlasMenuShowAll.isChecked()
+        self.updateAtlasOverlay()
+        
     def loadAtlasTemplate(self):
         if self.atlasTemplate is None:
             n = len(self.imageObjs)
@@ -1732,34 +2337,82 @@ class ImageGui():
             self.imageObjs[-1].pixelSize = [25.0]*3
         
     def setAtlasRegions(self):
+        # toggle the region chosen from the menu in the list of selected regions (acronyms)
+        sender = self.mainWin.sender()
+        if not self.loadAtlasData():
+            self.resetAtlasRegionMenu()
+            return
+        selectedRegions = [region for region in self.selectedAtlasRegions[self.selectedWindow] if region!=sender.text()]
+        if sender.isChecked():
+            selectedRegions.append(sender.text())
+        self.setSelectedAtlasRegions(selectedRegions)
+        
+    def searchAtlasRegions(self):
+        if not self.loadAtlasData():
+            return
+        tree = self.atlasAnnotationRegions
+        dialog = QtWidgets.QDialog(self.mainWin)
+        dialog.setWindowTitle('Select Atlas Regions')
+        searchEdit = QtWidgets.QLineEdit()
+        searchEdit.setPlaceholderText('Search acronym or name')
+        listbox = QtWidgets.QListWidget()
+        listbox.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        for structureID in tree.order:
+            acronym = tree.structures[structureID]['acronym']
+            item = QtWidgets.QListWidgetItem('  '*(len(tree.paths[structureID])-1)+acronym+' - '+tree.structures[structureID]['name'])
+            item.setData(QtCore.Qt.UserRole,acronym)
+            listbox.addItem(item)
+            item.setSelected(acronym in self.selectedAtlasRegions[self.selectedWindow])
+        def filterRegions(text):
+            text = text.lower()
+            for i in range(listbox.count()):
+                listbox.item(i).setHidden(text not in listbox.item(i).text().lower())
+        searchEdit.textChanged.connect(filterRegions)
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout = QtWidgets.QVBoxLayout(dialog)
+        for widget in (searchEdit,listbox,buttons):
+            layout.addWidget(widget)
+        dialog.resize(400,600)
+        if dialog.exec_()==QtWidgets.QDialog.Accepted:
+            self.setSelectedAtlasRegions([item.data(QtCore.Qt.UserRole) for item in listbox.selectedItems()])
+            
+    def setSelectedAtlasRegions(self,selectedRegions):
+        regionIDs = [self.getAtlasRegionID(region) for region in selectedRegions]
+        for region in self.atlasRegionMenu:
+            region.setChecked(region.text() in selectedRegions)
+        windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
+        for window in windows:
+            self.selectedAtlasRegions[window] = selectedRegions
+            self.selectedAtlasRegionIDs[window] = regionIDs
+        self.updateAtlasOverlay(windows)
+        
+    def loadAtlasData(self):
+        # load annotation volume and structure hierarchy if needed; returns False if cancelled
         if self.atlasAnnotationData is None:
             filePath,fileType = QtWidgets.QFileDialog.getOpenFileName(self.mainWin,'Choose Annotation Data File',self.fileOpenPath,'*.nrrd')
             if filePath=='':
-                self.resetAtlasRegionMenu()
-                return
+                return False
             self.fileOpenPath = os.path.dirname(filePath)
-            self.atlasAnnotationData,_ = nrrd.read(filePath)
-            self.atlasAnnotationData = self.atlasAnnotationData.transpose((1,2,0))
+            annotationData,_ = nrrd.read(filePath)
+            # annotation IDs are stored as dense uint16 indices into atlasLabelIDs
+            self.atlasAnnotationData,self.atlasLabelIDs = getLabelIndex(annotationData.transpose((1,2,0)))
+            self.atlasTransform = None
+            self.atlasColorLUT = None
+            self.atlasVersion += 1
         if self.atlasAnnotationRegions is None:
-            filePath,fileType = QtWidgets.QFileDialog.getOpenFileName(self.mainWin,'Choose Annotation Region Hierarchy File',self.fileOpenPath,'*.xml')
+            filePath,fileType = QtWidgets.QFileDialog.getOpenFileName(self.mainWin,'Choose Annotation Region Hierarchy File',self.fileOpenPath,'*.xml *.json')
             if filePath=='':
-                self.resetAtlasRegionMenu()
-                return
+                return False
             self.fileOpenPath = os.path.dirname(filePath)
-            self.atlasAnnotationRegions = minidom.parse(filePath)
-        selectedRegions = [ind for ind,region in enumerate(self.atlasRegionMenu) if region.isChecked()]
-        regionIDs = [self.getAtlasRegionID(self.atlasRegionLabels[ind]) for ind in selectedRegions]
-        windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
-        for window in windows:
-            self.selectedAtlasRegions[window] = selectedRegions
-            self.selectedAtlasRegionIDs[window] = regionIDs
-        self.displayImage(windows)
+            self.atlasAnnotationRegions = AtlasStructureTree(filePath)
+            self.atlasColorLUT = None
+        return True
         
     def getAtlasRegionID(self,regionLabel):
-        for structure in self.atlasAnnotationRegions.getElementsByTagName('structure'):
-            if structure.childNodes[7].childNodes[0].nodeValue[1:-1]==regionLabel:
-                return [int(sub.childNodes[0].nodeValue) for sub in structure.getElementsByTagName('id')]
-        return []
+        # ids of the region and all of its descendants
+        return self.atlasAnnotationRegions.getRegionIDs(regionLabel)
         
     def resetAtlasRegionMenu(self):
         for region in self.atlasRegionMenu:
@@ -1772,49 +2425,111 @@ class ImageGui():
             windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
             for window in windows:
                 self.selectedAtlasRegions[window] = []
-            self.displayImage(windows)
+            self.updateAtlasOverlay(windows)
             
     def setAtlasHemi(self):
         sender = self.mainWin.sender()
         for option in (self.atlasMenuHemiBoth,self.atlasMenuHemiLeft,self.atlasMenuHemiRight):
             option.setChecked(option is sender)
-        for window in self.displayedWindows:
-            if len(self.selectedAtlasRegions[window])>0:
-                self.displayImage([window])
+        self.atlasHemi = sender.text().lower()
+        self.updateAtlasOverlay()
             
     def rotateAnnotationData(self):
+        # the rotation is stored as a transform and only the displayed annotation planes are sampled
         if self.atlasAnnotationData is not None:
             for angle,axes in zip(self.rotationAngle,self.rotationAxes):
-                self.atlasAnnotationData = scipy.ndimage.interpolation.rotate(self.atlasAnnotationData,angle,axes,order=0)
+                self.atlasTransform = getRotationTransform(self.getAtlasShape(),angle,axes,self.atlasTransform)
+            self.atlasVersion += 1
+            
+    def applyAnnotationRotation(self):
+        # compute the whole rotated annotation volume
+        if self.atlasAnnotationData is not None and self.atlasTransform is not None:
+            matrix,offset,shape = self.atlasTransform
+            self.atlasAnnotationData = scipy.ndimage.affine_transform(self.atlasAnnotationData,matrix,offset,shape,order=0)
+            self.atlasTransform = None
+            self.atlasVersion += 1
+            
+    def getAtlasShape(self):
+        return self.atlasAnnotationData.shape if self.atlasTransform is None else self.atlasTransform[2]
+        
+    def getAtlasPlaneShape(self,axis):
+        shape = self.getAtlasShape()
+        if axis==2:
+            return shape[0],shape[1]
+        elif axis==1:
+            return shape[0],shape[2]
+        else:
+            return shape[2],shape[1]
+        
+    def getAtlasAnnotation(self,axis,ind,rows=slice(None),cols=slice(None)):
+        # annotation labels of the image plane at ind (int or slice) along axis
+        if axis==2:
+            index = (rows,cols,ind)
+        elif axis==1:
+            index = (rows,ind,cols)
+        else:
+            index = (ind,cols,rows)
+        if self.atlasTransform is None:
+            a = self.atlasAnnotationData[index]
+        else:
+            a = sampleTransformed(self.atlasAnnotationData,self.atlasTransform,index)
+        if axis==0:
+            a = a.T if a.ndim==2 else a.transpose((0,2,1))
+        return a
             
     def resetAnnotationData(self):
         self.clearAtlasRegions()
-        self.atlasAnnotationData = self.atlasAnnotationRegions = None
+        self.atlasAnnotationData = self.atlasTransform = self.atlasAnnotationRegions = self.atlasLabelIDs = self.atlasColorLUT = None
+        self.atlasMenuShowAll.setChecked(False)
+        self.atlasOverlayState = False
+        self.updateAtlasOverlay()
+        self.atlasVersion += 1
+                
+    def getAtlasRegionLUT(self,regionID):
+        # boolean lookup table indexed by atlasAnnotationData
+        return np.isin(self.atlasLabelIDs,regionID)
+        
+    def getAtlasRegionMask(self,regionID,zSlice,inside=True):
+        # region mask (or its complement) for a range of annotation slices, restricted to the selected hemisphere
+        lut = self.getAtlasRegionLUT(regionID)
+        if not inside:
+            lut = np.logical_not(lut)
+        mask = lut[self.getAtlasAnnotation(2,zSlice)]
+        if self.atlasHemi=='left':
+            mask[:,mask.shape[1]//2:] = not inside
+        elif self.atlasHemi=='right':
+            mask[:,:mask.shape[1]//2] = not inside
+        return mask
                 
     def normRegionLevels(self):
         if len(self.selectedAtlasRegions[self.selectedWindow])>0:
-            mask = np.in1d(self.atlasAnnotationData,self.selectedAtlasRegionIDs[self.selectedWindow][0]).reshape(self.atlasAnnotationData.shape)
-            if self.atlasMenuHemiLeft.isChecked():
-                mask[:,mask.shape[1]//2:] = 0
-            elif self.atlasMenuHemiRight.isChecked():
-                mask[:,:mask.shape[1]//2] = 0
-            for fileInd in set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex):
-                for ch in range(self.imageObjs[fileInd].shape[3]):
-                    self.imageObjs[fileInd].levels[ch][1] = self.imageObjs[fileInd].data[:,:,:,ch][mask].max()
+            regionID = self.selectedAtlasRegionIDs[self.selectedWindow][0]
+            fileInd = set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex)
+            maxLevel = {(i,ch): 0 for i in fileInd for ch in range(self.imageObjs[i].shape[3])}
+            for z in range(0,self.getAtlasShape()[2],16):
+                zSlice = slice(z,z+16)
+                mask = self.getAtlasRegionMask(regionID,zSlice)
+                if mask.any():
+                    for i,ch in maxLevel:
+                        maxLevel[(i,ch)] = max(maxLevel[(i,ch)],self.imageObjs[i].data[:,:,zSlice,ch][mask].max())
+            for (i,ch),level in maxLevel.items():
+                self.imageObjs[i].levels[ch][1] = level
             self.displayImageLevels()
             windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
             self.displayImage(windows)
         
     def setOutsideRegionZero(self):
         if len(self.selectedAtlasRegions[self.selectedWindow])>0:
-            mask = np.logical_not(np.in1d(self.atlasAnnotationData,self.selectedAtlasRegionIDs[self.selectedWindow][0]).reshape(self.atlasAnnotationData.shape))
-            if self.atlasMenuHemiLeft.isChecked():
-                mask[:,mask.shape[1]//2:] = 1
-            elif self.atlasMenuHemiRight.isChecked():
-                mask[:,:mask.shape[1]//2] = 1
-            for fileInd in set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex):
-                for ch in range(self.imageObjs[fileInd].shape[3]):
-                    self.imageObjs[fileInd].data[:,:,:,ch][mask] = 0
+            regionID = self.selectedAtlasRegionIDs[self.selectedWindow][0]
+            fileInd = set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex)
+            for z in range(0,self.getAtlasShape()[2],16):
+                zSlice = slice(z,z+16)
+                mask = self.getAtlasRegionMask(regionID,zSlice,inside=False)
+                for i in fileInd:
+                    for ch in range(self.imageObjs[i].shape[3]):
+                        self.imageObjs[i].data[:,:,zSlice,ch][mask] = 0
+            for i in fileInd:
+                self.imageObjs[i].dataModified()
             windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
             self.displayImage(windows)
         
@@ -1844,6 +2559,7 @@ class ImageGui():
                             d[:,swapInd] = d[:,swapInd[::-1],:]
                         else:
                             d[swapInd] = d[swapInd[::-1]]
+                        self.imageObjs[fileInd].dataModified(keepHistograms=True)
                     self.imageNumEditBoxes[axis].setText(str(imgInd+1))
                     self.imageIndex[self.selectedWindow][axis] = imgInd
                 else:
@@ -1897,7 +2613,10 @@ class ImageGui():
                                     data = self.imageObjs[fileInd].data[:,imgInd,:,ch]
                                 else:
                                     data = self.imageObjs[fileInd].data[imgInd,:,:,ch]
+                                before = data[mask]
                                 data[mask] = val
+                                self.imageObjs[fileInd].updateHistogram(ch,before,data[mask])
+                            self.imageObjs[fileInd].dataModified(keepHistograms=True)
                     else:
                         moveAxis,dist = self.getMoveParams(self.selectedWindow,key,modifiers,True)
                         if key in moveKeys[:4]:
@@ -1924,9 +2643,13 @@ class ImageGui():
                                         data = self.imageObjs[fileInd].data[:,imgInd,:,ch]
                                     else:
                                         data = self.imageObjs[fileInd].data[imgInd,:,:,ch]
+                                    changed = mask | shiftMask
+                                    before = data[changed]
                                     shiftData = data[mask].copy()
                                     data[mask] = 0
                                     data[shiftMask] = shiftData
+                                    self.imageObjs[fileInd].updateHistogram(ch,before,data[changed])
+                                self.imageObjs[fileInd].dataModified(keepHistograms=True)
                             self.markedPoints[self.selectedWindow][rows,moveAxis] += dist
                             cols = [moveAxis]
                         else:
@@ -1945,8 +2668,12 @@ class ImageGui():
                                     else:
                                         data = self.imageObjs[fileInd].data[imgInd,:,:,ch]
                                     rotData = cv2.warpAffine(data,rotMat,shape[::-1])
+                                    changed = mask | rotMask
+                                    before = data[changed]
                                     data[mask] = 0
                                     data[rotMask] = rotData[rotMask]
+                                    self.imageObjs[fileInd].updateHistogram(ch,before,data[changed])
+                                self.imageObjs[fileInd].dataModified(keepHistograms=True)
                             rotMat[[0,1],[1,0]] *= -1
                             rotMat[:,2] = rotMat[::-1,2]
                             cols = self.imageShapeIndex[self.selectedWindow][:2]
@@ -2046,7 +2773,8 @@ class ImageGui():
         self.imageDoubleClickCallback(event,window=3)
             
     def imageClickCallback(self,event,window):
-        x,y = int(event.pos().x()),int(event.pos().y())
+        pos = self.imageItem[window].mapToParent(event.pos())
+        x,y = int(pos.x()),int(pos.y())
         if not self.viewChannelsCheckbox.isChecked():
             self.windowListbox.setCurrentRow(window)
         if event.button()==QtCore.Qt.LeftButton:
@@ -2066,7 +2794,8 @@ class ImageGui():
             self.windowListbox.setCurrentRow(window)
         if event.button()==QtCore.Qt.LeftButton:
             if not self.analysisMenuPointsLock.isChecked():
-                x,y = (p*self.displayDownsample[window] for p in (event.pos().x(),event.pos().y()))
+                pos = self.imageItem[window].mapToParent(event.pos())
+                x,y = (p*self.displayDownsample[window] for p in (pos.x(),pos.y()))
                 newPoint = np.array([y,x,self.imageIndex[window][self.imageShapeIndex[window][2]]])[list(self.imageShapeIndex[window])]
                 windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [window]
                 for window in windows:
@@ -2187,6 +2916,8 @@ class ImageGui():
                     checked.remove(fileInd)
             self.imageObjs.remove(self.imageObjs[fileInd])
             self.fileListbox.takeItem(fileInd)
+        with self.frameBuffersLock:
+            self.frameBuffers.clear()
         self.stitchPos = np.delete(self.stitchPos,self.selectedFileIndex,axis=1)
         if self.stitchPos.shape[1]<1:
             self.stitchPos = np.full((self.numWindows,1,3),np.nan)
@@ -2210,6 +2941,7 @@ class ImageGui():
         sender = self.mainWin.sender()
         for option in (self.imageMenuStitchOverlayMax,self.imageMenuStitchOverlayReplace):
             option.setChecked(option is sender)
+        self.stitchOverlayMax = self.imageMenuStitchOverlayMax.isChecked()
         if self.stitchCheckbox.isChecked():
             windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
             self.displayImage(windows)
@@ -2331,8 +3063,8 @@ class ImageGui():
         self.normDisplayCheckbox.setChecked(self.normState[window])
         self.showBinaryCheckbox.setChecked(self.showBinaryState[window])
         self.stitchCheckbox.setChecked(self.stitchState[window])
-        for ind,region in enumerate(self.atlasRegionMenu):
-            region.setChecked(ind in self.selectedAtlasRegions[window])
+        for region in self.atlasRegionMenu:
+            region.setChecked(region.text() in self.selectedAtlasRegions[window])
         self.clearPointsTable()
         self.fillPointsTable()
         self.setSelectedPoints(None)
@@ -2508,7 +3240,7 @@ class ImageGui():
                 elif position is not None:
                     self.imageNumEditBoxes[axis].setText(str(pos+1))
                     self.imageIndex[window][axis] = pos
-                    self.displayImage([window])
+                    self.scheduleDisplay([window],throttle=True)
                     
     def setLinkedViewOn(self,numWindows):
         self.windowListbox.blockSignals(True)
@@ -2567,11 +3299,13 @@ class ImageGui():
         if self.view3dCheckbox.isChecked():
             self.updateView3dLines([axis],[imgInd])
         else:
+            step = int(np.sign(imgInd-self.imageIndex[self.selectedWindow][axis]))
             self.imageNumEditBoxes[axis].setText(str(imgInd+1))
             windows = self.displayedWindows if self.linkWindowsCheckbox.isChecked() else [self.selectedWindow]
             for window in windows:
                 self.imageIndex[window][axis] = imgInd
             self.displayImage(windows)
+            self.prefetchImages(windows,axis,step)
             if not self.linkWindowsCheckbox.isChecked():
                 self.alignWindows(self.selectedWindow,axis)
             
@@ -2679,9 +3413,11 @@ class ImageGui():
                             self.view3dSliceLines[window][ind].setValue(self.imageIndex[window][axis])
                         self.view3dSliceLines[window][ind].setBounds(rng)
             if self.imageShapeIndex[window][2] in axes and (imgIndChanged or self.sliceProjState[window]):
-                self.displayImage([window])
+                self.scheduleDisplay([window])
             if any(axis in self.imageShapeIndex[window][:2] for axis in axes):
                 self.setViewBoxRange([window])
+                if self.cropRenderState and not self.isImageRangeRendered(window):
+                    self.scheduleDisplay([window])
             if imgIndChanged and not self.linkWindowsCheckbox.isChecked():
                 self.alignWindows(window,axis)
         
@@ -2707,6 +3443,12 @@ class ImageGui():
             rangeBox[1].setText(str(rng[1]+1))
         self.setImageRange(savedRange)
         
+    def levelLineDragged(self):
+        # preview levels while a level line is being dragged; boxes and bounds are updated when the drag finishes
+        sender = self.mainWin.sender()
+        if sender.moving:
+            self.setLevels(sender.value(),levelsInd=0 if sender is self.lowLevelLine else 1,throttle=True)
+        
     def lowLevelLineCallback(self):
         val = self.lowLevelLine.value()
         self.lowLevelBox.blockSignals(True)
@@ -2741,13 +3483,13 @@ class ImageGui():
         self.lowLevelLine.setBounds(lowRange)
         self.setLevels(val,levelsInd=1)
         
-    def setLevels(self,newVal,levelsInd):
+    def setLevels(self,newVal,levelsInd,throttle=False):
         channels = [self.viewChannelsSelectedCh] if self.viewChannelsCheckbox.isChecked() else self.selectedChannels[self.selectedWindow]
         for fileInd in set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex):
             for ch in channels:
                 if ch<self.imageObjs[fileInd].shape[3]:
                     self.imageObjs[fileInd].levels[ch][levelsInd] = newVal
-        self.displayImage(self.getAffectedWindows(channels))
+        self.scheduleDisplay(self.getAffectedWindows(channels),throttle)
         
     def showLevelsButtonCallback(self):
         sender = self.mainWin.sender()
@@ -2764,12 +3506,12 @@ class ImageGui():
             for ch in channels:
                 if ch<self.imageObjs[fileInd].shape[3]:
                     self.imageObjs[fileInd].gamma[ch] = val
-        self.displayImage(self.getAffectedWindows(channels))
+        self.scheduleDisplay(self.getAffectedWindows(channels))
         
     def alphaBoxCallback(self,val):
         for fileInd in set(self.checkedFileIndex[self.selectedWindow]) & set(self.selectedFileIndex):
             self.imageObjs[fileInd].alpha = val
-        self.displayImage(self.getAffectedWindows())
+        self.scheduleDisplay(self.getAffectedWindows())
         
     def resetLevelsButtonCallback(self):
         self.lowLevelLine.setValue(0)
@@ -2927,7 +3669,9 @@ class ImageGui():
         rows = np.logical_and(ind>=rng[0],ind<=rng[1])
         if not any(rows):
             return
-        image = self.getImage()
+        crop = self.getDisplayCrop(self.selectedWindow,1)
+        image = self.getImage(atlas=False,crop=crop)
+        offset = (0,0) if crop is None else (crop[2],crop[0])
         pts = self.markedPoints[self.selectedWindow][rows][:,shapeIndex[1::-1]]
         color = tuple(self.levelsMax[self.selectedWindow]*c for c in self.markPointsColor)
         if sender is self.analysisMenuPointsDrawTri:
@@ -2936,16 +3680,16 @@ class ImageGui():
             pts = np.concatenate((pts,boundaryPts),axis=0).astype(np.float32)
             triangles = getDelauneyTriangles(pts,w,h)
             for tri in triangles:
-                p = [(tri[j],tri[j+1])for j in (0,2,4)]
+                p = [(tri[j]-offset[0],tri[j+1]-offset[1])for j in (0,2,4)]
                 cv2.line(image,p[0],p[1],color,1,cv2.LINE_AA)
                 cv2.line(image,p[1],p[2],color,1,cv2.LINE_AA)
                 cv2.line(image,p[2],p[0],color,1,cv2.LINE_AA)
         else:
             if sender is self.analysisMenuPointsDrawPoly:
                 pts = np.concatenate((pts,pts[-1]),axis=0)
-            for p in pts:
+            for p in pts-offset:
                 cv2.line(image,p[0],p[1],color,1,cv2.LINE_AA)
-        self.imageItem[self.selectedWindow].setImage(image.transpose((1,0,2)),levels=[0,self.levelsMax[self.selectedWindow]])
+        self.setImageItem(self.selectedWindow,image,[0,self.levelsMax[self.selectedWindow]],crop)
         
     def copyPoints(self):
         if self.markedPoints[self.selectedWindow] is None:
@@ -3161,9 +3905,13 @@ class ImageGui():
         self.alignRange[self.selectedWindow][ind] = int(val)-1 if str(val).isdigit() else None
         
     def getContours(self):
-        image = self.getImage(self.selectedWindow,downsample=self.displayDownsample[self.selectedWindow],binary=True)
-        yRange,xRange = [[r//self.displayDownsample[self.selectedWindow] for r in self.imageRange[self.selectedWindow][axis]] for axis in self.imageShapeIndex[self.selectedWindow][:2]]
-        roi = image[yRange[0]:yRange[1]+1,xRange[0]:xRange[1]+1]
+        downsample = self.displayDownsample[self.selectedWindow]
+        crop = self.getDisplayCrop(self.selectedWindow,downsample)
+        image = self.getImage(self.selectedWindow,downsample=downsample,binary=True,crop=crop)
+        # contours are in downsampled image plane coordinates; offset converts them to coordinates in the cropped image
+        offset = (0,0) if crop is None else (-crop[2]//downsample,-crop[0]//downsample)
+        yRange,xRange = [[r//downsample for r in self.imageRange[self.selectedWindow][axis]] for axis in self.imageShapeIndex[self.selectedWindow][:2]]
+        roi = image[yRange[0]+offset[1]:yRange[1]+1+offset[1],xRange[0]+offset[0]:xRange[1]+1+offset[0]]
         contours,_ = cv2.findContours(roi.max(axis=2),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
         contours = [c for c in contours if c.shape[0]>=self.minContourVertices]
         for c in contours:
@@ -3189,16 +3937,21 @@ class ImageGui():
             self.contourHulls.append(cv2.convexHull(m))
             x,y,w,h = cv2.boundingRect(m)
             self.contourRectangles.append([x-1,y-1,w+2,h+2])
-        color = tuple(255*c for c in self.contourLineColor)
-        lineWidth = -1 if self.analysisMenuContoursFill.isChecked() else 1
         sender = self.mainWin.sender()
         if sender is self.analysisMenuContoursFindRectangle:
-            for r in self.contourRectangles:
-                cv2.rectangle(image,(r[0],r[1]),(r[0]+r[2],r[1]+r[3]),color,lineWidth,cv2.LINE_AA)
+            path = QtGui.QPainterPath()
+            for x,y,w,h in self.contourRectangles:
+                path.addRect(x+offset[0]+0.5,y+offset[1]+0.5,w,h)
         else:
             c = mergedContours if sender is self.analysisMenuContoursFindContours else self.contourHulls
-            cv2.drawContours(image,c,-1,color,lineWidth,cv2.LINE_AA)
-        self.imageItem[self.selectedWindow].setImage(image.transpose((1,0,2)),levels=[0,255])
+            path = getContourPath(c,offset)
+        self.setImageItem(self.selectedWindow,image,[0,255],crop,downsample)
+        # contours are drawn on top of the binary image without changing it
+        color = [255*c for c in self.contourLineColor]
+        item = self.contourItem[self.selectedWindow]
+        item.setPath(path)
+        item.setPen(pg.mkPen(color))
+        item.setBrush(pg.mkBrush(color) if self.analysisMenuContoursFill.isChecked() else QtGui.QBrush())
         
     def setMinContourVertices(self):
         n,ok = QtWidgets.QInputDialog.getInt(self.mainWin,'Select','Minimum number of contour vertices',self.minContourVertices,min=1)
@@ -3228,12 +3981,19 @@ class ImageGui():
 class ImageObj():
     
     def __init__(self,filePath,fileType,chFileOrg,numCh,loadData,memmap,autoColor):
+        self.obliqueTransform = None
+        self.obliqueRotations = []
         self.data = None
         self.memmap = memmap
         self.alpha = 1
         self.alphaMap = None
+        self.sourceMax = None
         self.pixelSize = [None]*3
         self.position = None
+        self.indexLock = threading.RLock()
+        self.pyramidLock = threading.RLock()
+        self.histogramVersion = 0
+        self.dataModified()
         if isinstance(filePath,np.ndarray):
             self.fileType = 'data'
             self.filePath = None
@@ -3256,7 +4016,8 @@ class ImageObj():
                 else:
                     npy = open(filePath,'rb')
                 version = np.lib.format.read_magic(npy)
-                shape,fortran,dtype = np.lib.format._read_array_header(npy,version)
+                readHeader = np.lib.format.read_array_header_1_0 if version==(1,0) else np.lib.format.read_array_header_2_0
+                shape,fortran,dtype = readHeader(npy)
                 npy.close()
                 self.dtype = dtype if dtype==np.uint16 else np.uint8
                 numImg = shape[2] if len(shape)>2 else 1
@@ -3267,18 +4028,51 @@ class ImageObj():
             elif fileExt in ('nrrd','nii'):
                 self.fileType = fileExt
                 self.filePath = filePath
-                self.dtype = np.uint8
-                self.shape = (320,456,528,1)
-                self.pixelSize = [25.0]*3
+                if fileExt=='nrrd':
+                    header = nrrd.read_header(filePath)
+                    shape = tuple(int(n) for n in header['sizes'])
+                    dtype = getNrrdDtype(header)
+                    if 'space directions' in header:
+                        spacing = [np.linalg.norm(d) for d in np.array(header['space directions'],dtype=float)]
+                    else:
+                        spacing = header.get('spacings',[None]*3)
+                else:
+                    img = nibabel.load(filePath)
+                    shape = img.shape
+                    dtype = img.get_data_dtype()
+                    # pixel sizes are in microns; nifti spacing is usually in mm (assumed when the units are unknown)
+                    scale = {'meter':1e6,'micron':1}.get(img.header.get_xyzt_units()[0],1e3)
+                    spacing = [float(z)*scale for z in img.header.get_zooms()[:3]]
+                # volumes are displayed transposed to (y,z,x); big endian data are byte swapped when read
+                self.dtype = np.uint16 if np.dtype(dtype).newbyteorder('=')==np.uint16 else np.uint8
+                self.shape = (shape[1],shape[2],shape[0],1)
+                self.pixelSize = [None if spacing[i] is None or np.isnan(spacing[i]) else round(float(spacing[i]),4) for i in (1,2,0)]
+            elif fileExt in ('tif','btf') and isTiffPyramid(filePath,tiled=not loadData):
+                # pyramidal (or tiled) tiff files are read by region from the resolution level matching the display downsampling
+                self.fileType = 'tiffPyramid'
+                self.filePath = filePath
+                self.tiffPyramid = TiffPyramid(filePath)
+                self.dtype = self.tiffPyramid.dtype.type
+                self.shape = self.tiffPyramid.shapes[0]+(1,self.tiffPyramid.numCh)
             else:
                 self.fileType = 'bigtiff' if fileExt=='btf' else 'image'
                 self.dtype,shape,numCh = getImageInfo(filePath)
                 self.filePath = [[filePath]]*numCh
                 self.shape = shape+(1,numCh)  
+        elif fileType=='Chunked Volume (*.zarr)':
+            self.fileType = 'chunked'
+            self.filePath = filePath
+            self.volume = ChunkedVolume(filePath)
+            level = self.volume.levels[0]
+            self.dtype = level['dtype'].type if level['dtype']==np.uint16 else np.uint8
+            self.shape = level['shape']
+            if self.volume.pixelSize is not None:
+                self.pixelSize = self.volume.pixelSize
         elif fileType=='Image Series (*.tif *.btf *.png *.jpg *.jp2)':
+            imageInfo = getImageInfoList(filePath)
             for ind,f in enumerate(filePath):
                 fext = os.path.splitext(f)[1][1:]
-                dtype,s,n = getImageInfo(f)
+                dtype,s,n = imageInfo[ind]
                 if ind==0:
                     if numCh is None:
                         numCh = n
@@ -3338,20 +4132,117 @@ class ImageObj():
         self.bitDepth = 16 if self.dtype==np.uint16 else 8
         self.levels = [[0,2**self.bitDepth-1] for _ in range(self.shape[3])]
         self.gamma = [1]*self.shape[3]
+        self.lut = {}
         self.rgbInd = [(0,1,2) for _ in range(self.shape[3])]
         if autoColor:
             for ch in range(self.shape[3])[:3]:
                 self.rgbInd[ch] = (ch,)
         if self.data is None:
-            if loadData:
-                self.data = self.getData()
+            if loadData and self.fileType!='tiffPyramid':
+                if self.fileType=='numpy' and self.memmap:
+                    # copy on write so that edits do not change the file
+                    self.data = self.formatData(self.getNumpyArray('c'))
+                else:
+                    self.data = self.getData()
         else:
             self.data = self.formatData(self.data)
             
+    @property
+    def data(self):
+        # a pending oblique rotation is applied before the data are used by anything other than the display
+        if self.obliqueTransform is not None:
+            self.applyObliqueRotation()
+        return self.sourceData
+        
+    @data.setter
+    def data(self,data):
+        self.sourceData = data
+            
+    def dataModified(self,keepHistograms=False):
+        # call after any change to data so that cached display frames are not reused
+        # keepHistograms if values were only rearranged or histograms were updated with updateHistogram
+        self.dataVersion = next(dataVersionCounter)
+        if not keepHistograms:
+            with self.indexLock:
+                self.histograms = {}
+                self.histogramVersion += 1
+        self.rangeMax = {}
+        self.pyramid = {}
+        
+    def computeHistogram(self,ch):
+        # counts of each intensity in one channel of the whole volume
+        version = self.histogramVersion
+        hist = np.zeros(2**self.bitDepth,dtype=np.int64)
+        if self.sourceData is None and self.fileType=='tiffPyramid':
+            # counts from the coarsest resolution level with enough pixels, scaled to the number of full resolution pixels
+            shapes = self.tiffPyramid.shapes
+            level = max([i for i,(h,w) in enumerate(shapes) if h*w>=2**22] or [0])
+            h,w = shapes[level]
+            levelHist = np.bincount(self.tiffPyramid.read(level,slice(0,h),slice(0,w),[ch]).ravel(),minlength=hist.size)[:hist.size]
+            hist += np.round(levelHist*(shapes[0][0]*shapes[0][1]/(h*w))).astype(np.int64)
+            planes = ()
+        elif self.sourceData is None:
+            planes = self.getDataIterator([ch])
+        else:
+            # a pending oblique rotation only resamples the same intensities, so the unrotated data are used
+            planes = (self.sourceData[:,:,i:i+16,ch] for i in range(0,self.sourceData.shape[2],16))
+        for d in planes:
+            hist += np.bincount(d.ravel(),minlength=hist.size)[:hist.size]
+        with self.indexLock:
+            if version==self.histogramVersion:
+                self.histograms[ch] = hist
+        return hist
+        
+    def updateHistogram(self,ch,before,after):
+        # adjust a cached histogram for an in place edit; before and after are the changed values
+        with self.indexLock:
+            if ch in self.histograms:
+                hist = self.histograms[ch]
+                self.histograms[ch] = hist-np.bincount(before.ravel(),minlength=hist.size)[:hist.size]+np.bincount(after.ravel(),minlength=hist.size)[:hist.size]
+            else:
+                # discard a histogram that is being computed
+                self.histogramVersion += 1
+        
+    def getRangeMax(self,axis,rangeSlice,channels,factor=1,planeIndex=(slice(None),slice(None))):
+        # max projection over rangeSlice along axis using a block max index built on first use
+        with self.indexLock:
+            if (axis,factor) not in self.rangeMax:
+                self.rangeMax[(axis,factor)] = RangeMaxIndex(self.getPyramidLevel(axis,factor),axis)
+            index = self.rangeMax[(axis,factor)]
+        return index.getMax(rangeSlice.start,rangeSlice.stop,channels,planeIndex)
+        
+    def getPyramidFactor(self,downsample):
+        return max(f for f in (1,2,4,8) if downsample%f==0)
+        
+    def isPyramidLevelReady(self,axis,factor):
+        return factor==1 or (axis,factor) in self.pyramid
+        
+    def getPyramidLevel(self,axis,factor):
+        # data averaged over factor x factor blocks in the plane orthogonal to axis, built on first use
+        # levels are built under their own lock so that a build in the background does not block display of other data
+        if factor==1:
+            return self.data
+        pyramid = self.pyramid
+        if (axis,factor) not in pyramid:
+            with self.pyramidLock:
+                if (axis,factor) not in pyramid:
+                    pyramid[(axis,factor)] = downsampleVolume(self.getPyramidLevel(axis,factor//2),axis)
+                    if pyramid is self.pyramid:
+                        # cached frames strided from the full resolution data are not reused
+                        self.dataVersion = next(dataVersionCounter)
+        return pyramid[(axis,factor)]
+        
+    def getLUT(self,ch,levelsMax,binary=False):
+        # one cached lookup table per channel and display mode, rebuilt when levels or gamma change
+        params = (tuple(self.levels[ch]),self.gamma[ch],levelsMax,self.bitDepth)
+        key = (ch,binary)
+        if key not in self.lut or self.lut[key][0]!=params:
+            self.lut[key] = (params,makeLUT(2**self.bitDepth,self.levels[ch],levelsMax,self.gamma[ch],binary))
+        return self.lut[key][1]
+            
     def getOffsets(self):
         offset = np.zeros((self.shape[2],2),dtype=int)
-        for img in range(self.shape[2]):
-            imgShape = getImageInfo(self.filePath[0][img])[1]
+        for img,(_,imgShape,_) in enumerate(getImageInfoList(self.filePath[0][:self.shape[2]])):
             offset[img] = [(self.shape[n]-imgShape[n])//2 for n in (0,1)]
         return offset
             
@@ -3377,26 +4268,86 @@ class ImageObj():
                             data[i:i+d.shape[0],j:j+d.shape[1],ind,c] = d
                 return data
             elif self.fileType=='numpy':
-                d = np.load(self.filePath)
-                if isinstance(d,np.lib.npyio.NpzFile):
-                    d = d[list(d.keys())[0]]
-                data = self.formatData(d)
-            elif self.fileType=='nrrd':
-                data,_ = nrrd.read(self.filePath)
-                data = self.formatData(data.transpose((1,2,0)))
-            elif self.fileType=='nii':
-                d = nibabel.nifti1.load(self.filePath)
-                data = d.get_data()
-                data = self.formatData(data.transpose((1,2,0)))
+                d = self.getNumpyArray()
+                if d.ndim>2 and not (d.ndim>3 and d.shape[3]==4):
+                    # only the requested images are read from the memory map and scaled to the range of the whole array
+                    data = self.formatData(d[:,:,rangeSlice],None if d.dtype==self.dtype else self.getSourceMax(d))
+                    rangeSlice = slice(0,data.shape[2])
+                else:
+                    data = self.formatData(d)
+            elif self.fileType=='chunked':
+                # only the chunks containing the requested images are read
+                data = self.formatData(self.volume.read(0,(slice(None),slice(None),rangeSlice,slice(None))))
+                rangeSlice = slice(0,data.shape[2])
+            elif self.fileType=='tiffPyramid':
+                data = self.formatData(self.tiffPyramid.read(0,slice(0,self.shape[0]),slice(0,self.shape[1]),channels)[:,:,None,:])
+                channels = list(range(len(channels)))
+            elif self.fileType in ('nrrd','nii'):
+                # intensities are scaled to the range of the whole volume
+                d = self.getVolumeData(rangeSlice)
+                data = self.formatData(d,None if d.dtype==self.dtype else self.getSourceMax())
+                rangeSlice = slice(0,data.shape[2])
         else:
             data = self.data
         return data[:,:,rangeSlice,channels]
         
+    def getNumpyArray(self,mode='r'):
+        # memory map of a .npy file or of an uncompressed .npz member; compressed members are read into memory
+        if os.path.splitext(self.filePath)[1]=='.npz':
+            with zipfile.ZipFile(self.filePath) as z:
+                info = z.infolist()[0]
+                if info.compress_type!=zipfile.ZIP_STORED:
+                    with z.open(info) as member:
+                        return np.lib.format.read_array(member)
+            with open(self.filePath,'rb') as f:
+                # the member data follow its local file header
+                f.seek(info.header_offset)
+                nameLength,extraLength = struct.unpack('<HH',f.read(30)[26:30])
+                f.seek(info.header_offset+30+nameLength+extraLength)
+                version = np.lib.format.read_magic(f)
+                readHeader = np.lib.format.read_array_header_1_0 if version==(1,0) else np.lib.format.read_array_header_2_0
+                shape,fortran,dtype = readHeader(f)
+                offset = f.tell()
+            return np.memmap(self.filePath,dtype=dtype,mode=mode,offset=offset,shape=shape,order='F' if fortran else 'C')
+        return np.load(self.filePath,mmap_mode=mode)
+        
+    def getVolumeData(self,rangeSlice=slice(None)):
+        # nrrd or nifti volume transposed to height x width x n; only images in rangeSlice are read
+        # raw nrrd files are memory mapped and nifti files are sliced through the nibabel array proxy
+        if self.fileType=='nrrd':
+            with open(self.filePath,'rb') as f:
+                header = nrrd.read_header(f)
+                offset = f.tell()
+            if header['encoding']=='raw' and 'data file' not in header and header.get('line skip',0)==0 and header.get('byte skip',0)==0:
+                d = np.memmap(self.filePath,dtype=getNrrdDtype(header),mode='r',offset=offset,shape=tuple(int(n) for n in header['sizes']),order='F')
+            else:
+                d,_ = nrrd.read(self.filePath)
+            d = d[rangeSlice]
+        else:
+            d = np.asanyarray(nibabel.load(self.filePath).dataobj[rangeSlice])
+        if not d.dtype.isnative:
+            d = d.astype(d.dtype.newbyteorder('='))
+        return d.transpose((1,2,0))
+        
     def getDataIterator(self,channels=None,rangeSlice=None):
         if channels is None:
             channels = list(range(self.shape[3]))
         if rangeSlice is None:
             rangeSlice = slice(0,self.shape[2])
+        if self.data is None and self.fileType=='chunked':
+            # read one chunk deep slab at a time
+            depth = self.volume.levels[0]['chunks'][2]
+            for z in range(rangeSlice.start,rangeSlice.stop,depth):
+                slab = self.getData(channels,slice(z,min(z+depth,rangeSlice.stop)))
+                for i in range(slab.shape[2]):
+                    for c in range(len(channels)):
+                        yield slab[:,:,i,c]
+            return
+        if self.data is None and self.fileType=='tiffPyramid':
+            # read one channel of the full resolution image at a time
+            for ch in channels:
+                yield self.getData([ch])[:,:,0,0]
+            return
         if self.data is None:
             data = None if self.fileType in ('image','bigtiff') else self.getData(channels,rangeSlice)
         else:
@@ -3404,7 +4355,13 @@ class ImageObj():
         for img in range(rangeSlice.start,rangeSlice.stop):
             for ch in channels:
                 if data is None:
-                    imgData = getImageData(self.filePath[ch][img],self.memmap)
+                    f = self.filePath[ch][img]
+                    if os.path.splitext(f)[1][1:] in ('tif','btf'):
+                        # decode only the page of this channel; pages of multipage files are in reverse channel order as in getImageData
+                        numPages = tiffPagePool.getNumPages(f)
+                        imgData = tiffPagePool.getPage(f,numPages-1-ch if numPages>1 else 0)
+                    else:
+                        imgData = getImageData(f,self.memmap)
                     if len(imgData.shape)<3:
                         numCh = 1
                         dshape = self.shape[:2]
@@ -3424,10 +4381,21 @@ class ImageObj():
                 else:
                     yield data[:,:,img,ch]
         
-    def formatData(self,data):
+    def getSourceMax(self,d=None):
+        # max of the whole lazily read array, computed once
+        if self.sourceMax is None:
+            if d is None:
+                d = self.getVolumeData()
+            self.sourceMax = float(np.nanmax(d))
+        return self.sourceMax
+        
+    def formatData(self,data,maxVal=None):
         if data.dtype!=self.dtype:
             data = data.astype(float)
-            data *= (2**self.bitDepth-1)/np.nanmax(data)
+            if maxVal is None:
+                maxVal = np.nanmax(data)
+            if maxVal>0:
+                data *= (2**self.bitDepth-1)/maxVal
             data.round(out=data)
             data = data.astype(self.dtype)
         if len(data.shape)<3:
@@ -3454,6 +4422,7 @@ class ImageObj():
         self.dtype = dtype
         self.bitDepth = bitDepth
         self.levels = [[int(round(level*scaleFactor)) for level in levels] for levels in self.levels]
+        self.dataModified()
         
     def invert(self):
         if self.data is None:
@@ -3462,6 +4431,7 @@ class ImageObj():
             levelsMax = 2**self.bitDepth-1
             self.data = levelsMax - self.data
             self.levels = [[levelsMax-level for level in reversed(levels)] for levels in self.levels]
+            self.dataModified()
             
     def normalize(self,option):
         if self.data is None:
@@ -3483,6 +4453,7 @@ class ImageObj():
                     data[:,:,:,ch] /= (dmax-dmin)/(2**self.bitDepth-1)
             self.data = data.astype(self.dtype)
             self.levels = [[0,2**self.bitDepth-1] for _ in range(self.shape[3])]
+            self.dataModified()
             
     def changeBackground(self,option,thresh):
         if self.data is None:
@@ -3493,6 +4464,7 @@ class ImageObj():
                 self.data[np.all(self.data<=maxLevel*thresh,axis=3)] = maxLevel
             else:
                 self.data[np.all(self.data>=maxLevel*(1-thresh),axis=3)] = 0
+            self.dataModified()
         
     def flip(self,axis,imgAxis=None,imgInd=None):
         if self.data is None:
@@ -3506,6 +4478,7 @@ class ImageObj():
             flipInd = ind[:]
             flipInd[axis] = slice(None,None,-1)
             self.data[ind] = self.data[flipInd]
+        self.dataModified(keepHistograms=True)
         
     def rotate90(self,direction,axes):
         if self.data is None:
@@ -3513,15 +4486,475 @@ class ImageObj():
         else:
             self.data = np.rot90(self.data,direction,axes)
             self.shape = self.data.shape
+            self.dataModified(keepHistograms=True)
             
-    def rotate(self,angle,axes):
-        if self.data is None:
-            pass
-        else:
-            self.data = scipy.ndimage.interpolation.rotate(self.data,angle,axes)
-            self.shape = self.data.shape
+    def setObliqueRotation(self,angle,axes):
+        # store the rotation composed with any pending rotation; only displayed planes are resampled until the rotation is applied
+        # sourceData is checked because the data property would apply the pending rotation
+        if self.sourceData is None:
+            return
+        self.obliqueTransform = getRotationTransform(self.shape,angle,axes,self.obliqueTransform)
+        self.obliqueRotations.append((angle,axes))
+        self.shape = self.obliqueTransform[2]+self.shape[3:]
+        self.dataModified()
+            
+    def getObliqueData(self,index,channels,axis):
+        # max projection along axis of index (slices of the rotated volume for each spatial axis)
+        return np.stack([sampleTransformed(self.sourceData[:,:,:,ch],self.obliqueTransform,index,order=1,maxAxis=axis) for ch in channels],axis=-1)
+        
+    def applyObliqueRotation(self,progress=None):
+        # the pending rotations are applied with rotateVolume as if they had not been deferred
+        # returns False if cancelled by progress, in which case the rotation is still pending
+        if self.obliqueTransform is not None:
+            data = rotateVolumes([self.sourceData],self.obliqueRotations,[self.memmap],progress)
+            if data is None:
+                return False
+            self.sourceData = data[0]
+            self.obliqueTransform = None
+            self.obliqueRotations = []
+            self.shape = self.sourceData.shape
+            self.dataModified()
+        return True
 
 
+class LRUCache():
+    
+    def __init__(self,maxBytes,getSize=None):
+        self.maxBytes = maxBytes
+        self.getSize = (lambda item: item.nbytes) if getSize is None else getSize
+        self.nbytes = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+    def get(self,key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key][0]
+        
+    def put(self,key,item):
+        size = self.getSize(item)
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+            if size<=self.maxBytes:
+                self.items[key] = (item,size)
+                self.nbytes += size
+            self.trim()
+            
+    def trim(self):
+        while self.nbytes>self.maxBytes:
+            self.nbytes -= self.items.popitem(last=False)[1][1]
+            
+    def setMaxBytes(self,maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+            self.trim()
+            
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+
+class RangeMaxIndex():
+    
+    def __init__(self,data,axis):
+        # level k holds the max of consecutive blocks of 2**k planes along axis (level 0 is a view of data)
+        self.levels = [np.moveaxis(data,axis,0)]
+        while self.levels[-1].shape[0]>1:
+            d = self.levels[-1]
+            n = d.shape[0]
+            level = np.empty(((n+1)//2,)+d.shape[1:],dtype=d.dtype)
+            np.maximum(d[0:n-1:2],d[1::2],out=level[:n//2])
+            if n%2:
+                level[-1] = d[-1]
+            self.levels.append(level)
+            
+    def getMax(self,start,stop,channels,planeIndex=(slice(None),slice(None))):
+        # max over planes start to stop-1, merging at most 2 blocks per level; planeIndex crops each plane
+        out = None
+        lo,hi = start,stop
+        for level in self.levels:
+            if lo>=hi:
+                break
+            blocks = []
+            if lo&1:
+                blocks.append(lo)
+                lo += 1
+            if hi&1:
+                hi -= 1
+                blocks.append(hi)
+            for i in blocks:
+                if out is None:
+                    out = level[i][planeIndex+(channels,)].copy()
+                else:
+                    np.maximum(out,level[i][planeIndex+(channels,)],out=out)
+            lo >>= 1
+            hi >>= 1
+        return out
+
+
+class AtlasStructureTree():
+    
+    def __init__(self,filePath):
+        # structure hierarchy from Allen xml or json (structure_graph) file, cached in a json file next to it
+        # structures are stored in depth first order as {id: {'acronym','name','parent','color'}}
+        cachePath = filePath+'.cache.json'
+        fileStat = os.stat(filePath)
+        fileKey = [fileStat.st_mtime,fileStat.st_size]
+        self.structures = None
+        if os.path.isfile(cachePath):
+            with open(cachePath,'r') as f:
+                cache = json.load(f)
+            if cache['fileKey']==fileKey:
+                self.structures = collections.OrderedDict((s[0],dict(zip(('parent','acronym','name','color'),s[1:]))) for s in cache['structures'])
+        if self.structures is None:
+            if os.path.splitext(filePath)[1]=='.json':
+                self.structures = self.parseJson(filePath)
+            else:
+                self.structures = self.parseXml(filePath)
+            try:
+                with open(cachePath,'w') as f:
+                    json.dump({'fileKey':fileKey,'structures':[[i,s['parent'],s['acronym'],s['name'],s['color']] for i,s in self.structures.items()]},f)
+            except OSError:
+                pass
+        self.order = list(self.structures.keys())
+        self.acronyms = {s['acronym']: i for i,s in self.structures.items()}
+        self.children = {i: [] for i in self.order}
+        self.paths = {}
+        for i in self.order:
+            parent = self.structures[i]['parent']
+            if parent in self.structures:
+                self.children[parent].append(i)
+                self.paths[i] = self.paths[parent]+[i]
+            else:
+                self.paths[i] = [i]
+        self.descendants = {}
+        for i in reversed(self.order):
+            self.descendants[i] = [i]+[d for c in self.children[i] for d in self.descendants[c]]
+            
+    def parseXml(self,filePath):
+        structures = collections.OrderedDict()
+        nodeIDs = {}
+        for node in minidom.parse(filePath).getElementsByTagName('structure'):
+            fields = {child.nodeName: child.childNodes[0].nodeValue.strip('"') for child in node.childNodes if child.nodeType==child.ELEMENT_NODE and child.nodeName!='children' and len(child.childNodes)>0}
+            nodeIDs[id(node)] = int(fields['id'])
+            # parents precede their children in document order
+            parent = nodeIDs.get(id(node.parentNode.parentNode)) if node.parentNode.nodeName=='children' else None
+            structures[int(fields['id'])] = {'parent':parent,'acronym':fields.get('acronym',''),'name':fields.get('name',''),'color':fields.get('color-hex-triplet','FFFFFF')}
+        return structures
+        
+    def parseJson(self,filePath):
+        with open(filePath,'r') as f:
+            graph = json.load(f)
+        structures = collections.OrderedDict()
+        stack = list(reversed(graph['msg'] if 'msg' in graph else [graph]))
+        while len(stack)>0:
+            s = stack.pop()
+            structures[s['id']] = {'parent':s.get('parent_structure_id'),'acronym':s['acronym'],'name':s['name'],'color':s.get('color_hex_triplet','FFFFFF')}
+            stack.extend(reversed(s.get('children',[])))
+        return structures
+        
+    def getRegionIDs(self,acronym):
+        return self.descendants[self.acronyms[acronym]] if acronym in self.acronyms else []
+        
+
+class MainThreadCaller(QtCore.QObject):
+    
+    # emit a function from any thread to call it on the thread that created this object
+    sig = QtCore.pyqtSignal(object)
+    
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self.sig.connect(self.call)
+        
+    def call(self,func):
+        func()
+        
+        
+class TiffPagePool():
+    
+    def __init__(self,maxFiles=64):
+        # least recently used open TiffFile handles so that single pages can be decoded without opening the file again
+        self.maxFiles = maxFiles
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+    @contextlib.contextmanager
+    def openFile(self,filePath):
+        # yields the open TiffFile with its lock held for reading
+        # an evicted file is closed by its last reader so that eviction never closes a file being read
+        with self.lock:
+            if filePath in self.files:
+                self.files.move_to_end(filePath)
+            else:
+                tif = tifffile.TiffFile(filePath)
+                self.files[filePath] = {'tif':tif,'lock':threading.Lock(),'readers':0,'evicted':False}
+            entry = self.files[filePath]
+            entry['readers'] += 1
+            while len(self.files)>self.maxFiles:
+                self.evict(self.files.popitem(last=False)[1])
+        try:
+            with entry['lock']:
+                yield entry['tif']
+        finally:
+            with self.lock:
+                entry['readers'] -= 1
+                if entry['evicted'] and entry['readers']==0:
+                    entry['tif'].close()
+                    
+    def evict(self,entry):
+        # called with self.lock held
+        entry['evicted'] = True
+        if entry['readers']==0:
+            entry['tif'].close()
+        
+    def getNumPages(self,filePath):
+        with self.openFile(filePath) as tif:
+            return len(tif.pages)
+        
+    def getPage(self,filePath,pageIndex):
+        with self.openFile(filePath) as tif:
+            return tif.pages[pageIndex].asarray()
+        
+    def closeAll(self):
+        with self.lock:
+            for entry in self.files.values():
+                self.evict(entry)
+            self.files.clear()
+
+        
+class TiffPyramid():
+    
+    def __init__(self,filePath):
+        # resolution levels (series levels or SubIFDs) of a tiled or striped (OME-)TIFF image with axes YX, YXS or CYX
+        self.filePath = filePath
+        with tiffPagePool.openFile(filePath) as tif:
+            series = tif.series[0]
+            self.channelPages = series.axes=='CYX'
+            self.numCh = series.shape[0] if self.channelPages else (series.shape[2] if series.axes=='YXS' else 1)
+            self.dtype = series.dtype
+            self.shapes = [tuple(level.shape[1:3]) if self.channelPages else tuple(level.shape[:2]) for level in series.levels]
+        self.factors = [int(round(self.shapes[0][1]/shape[1])) for shape in self.shapes]
+        self.tileCache = LRUCache(256*2**20,lambda tile: tile[0].nbytes)
+        
+    def getLevel(self,downsample):
+        # highest level whose downsampling factor divides downsample
+        return max(i for i,factor in enumerate(self.factors) if downsample%factor==0)
+        
+    def getTileSize(self,level):
+        with tiffPagePool.openFile(self.filePath) as tif:
+            keyframe = tif.series[0].levels[level].keyframe
+            if keyframe.is_tiled:
+                return keyframe.tilelength,keyframe.tilewidth
+            return min(keyframe.rowsperstrip,self.shapes[level][0]),self.shapes[level][1]
+        
+    def getTile(self,level,ch,rowInd,colInd):
+        # returns (decoded tile or strip,row,col) of channel ch
+        key = (level,ch,rowInd,colInd)
+        tile = self.tileCache.get(key)
+        if tile is None:
+            height,width = self.shapes[level]
+            tileLength,tileWidth = self.getTileSize(level)
+            tilesDown = int(math.ceil(height/tileLength))
+            tilesAcross = int(math.ceil(width/tileWidth))
+            with tiffPagePool.openFile(self.filePath) as tif:
+                pages = tif.series[0].levels[level].pages
+                page = pages[ch] if self.channelPages else pages[0]
+                keyframe = page.keyframe
+                plane = ch if not self.channelPages and keyframe.planarconfig==2 else 0
+                segInd = (plane*tilesDown+rowInd)*tilesAcross+colInd
+                offset,byteCount = page.dataoffsets[segInd],page.databytecounts[segInd]
+                if byteCount>0:
+                    tif.filehandle.seek(offset)
+                    segData = tif.filehandle.read(byteCount)
+                else:
+                    segData = None
+            # decoding is done outside of the file lock so that tiles can be decoded concurrently
+            seg,(_,_,row,col,_),_ = keyframe.decode(segData,segInd,jpegtables=keyframe.jpegtables)
+            if seg is None:
+                seg = np.zeros((tileLength,tileWidth),dtype=self.dtype)
+            else:
+                seg = seg[0]
+                seg = np.ascontiguousarray(seg[:,:,ch if seg.shape[2]>1 else 0])
+            tile = (seg,row,col)
+            self.tileCache.put(key,tile)
+        return tile
+        
+    def read(self,level,rows,cols,channels):
+        # rows and cols are slices (step 1) of the level image; only intersecting tiles are decoded
+        # parts of the slices outside of the level image are zero
+        height,width = self.shapes[level]
+        out = np.zeros((rows.stop-rows.start,cols.stop-cols.start,len(channels)),dtype=self.dtype)
+        r0,r1 = max(0,rows.start),min(height,rows.stop)
+        c0,c1 = max(0,cols.start),min(width,cols.stop)
+        if r1<=r0 or c1<=c0:
+            return out
+        tileLength,tileWidth = self.getTileSize(level)
+        for chInd,ch in enumerate(channels):
+            for rowInd in range(r0//tileLength,(r1-1)//tileLength+1):
+                for colInd in range(c0//tileWidth,(c1-1)//tileWidth+1):
+                    tile,row,col = self.getTile(level,ch,rowInd,colInd)
+                    i0,i1 = max(r0,row),min(r1,row+tile.shape[0])
+                    j0,j1 = max(c0,col),min(c1,col+tile.shape[1])
+                    out[i0-rows.start:i1-rows.start,j0-cols.start:j1-cols.start,chInd] = tile[i0-row:i1-row,j0-col:j1-col]
+        return out
+
+        
+class ChunkedVolume():
+    
+    def __init__(self,dirPath):
+        # multiscale zarr (v2) group of zlib compressed chunks of a height x width x n x channels volume
+        # level k is averaged over 2**k x 2**k x 2**k blocks
+        self.dirPath = dirPath
+        with open(os.path.join(dirPath,'.zattrs'),'r') as f:
+            attrs = json.load(f)
+        self.pixelSize = attrs.get('pixelSize')
+        if 'multiscales' not in attrs or not attrs['multiscales'][0].get('datasets'):
+            raise ValueError('Unsupported zarr group: .zattrs has no multiscales datasets')
+        axes = attrs['multiscales'][0].get('axes')
+        if axes is not None and len(axes)!=4:
+            raise ValueError('Unsupported zarr group: multiscales axes must be (y,x,z,c), got '+str(len(axes))+' axes')
+        self.levels = []
+        for dataset in attrs['multiscales'][0]['datasets']:
+            with open(os.path.join(dirPath,dataset['path'],'.zarray'),'r') as f:
+                zarray = json.load(f)
+            compressor = zarray.get('compressor')
+            if (compressor is not None and compressor.get('id')!='zlib') or zarray.get('filters') or zarray.get('order','C')!='C' or zarray.get('dimension_separator','.')!='.':
+                raise ValueError('Unsupported zarr array '+dataset['path']+': chunks must be uncompressed or zlib compressed, in C order, without filters and named with . separators')
+            if len(zarray['shape'])!=4 or len(zarray['chunks'])!=4:
+                raise ValueError('Unsupported zarr array '+dataset['path']+': shape must be 4D (y,x,z,c), got '+str(tuple(zarray['shape'])))
+            self.levels.append({'path':dataset['path'],'shape':tuple(zarray['shape']),'chunks':tuple(zarray['chunks']),'dtype':np.dtype(zarray['dtype']),'fill':zarray['fill_value'] or 0,'compressed':compressor is not None})
+        self.chunkCache = LRUCache(256*2**20)
+        
+    def getLevel(self,downsample):
+        # highest level whose downsampling factor divides downsample
+        return max(i for i in range(len(self.levels)) if downsample%2**i==0)
+        
+    def getChunk(self,level,chunkIndex):
+        key = (level,chunkIndex)
+        chunk = self.chunkCache.get(key)
+        if chunk is None:
+            lev = self.levels[level]
+            chunkPath = os.path.join(self.dirPath,lev['path'],'.'.join(str(i) for i in chunkIndex))
+            if os.path.isfile(chunkPath):
+                with open(chunkPath,'rb') as f:
+                    chunk = f.read()
+                if lev['compressed']:
+                    chunk = zlib.decompress(chunk)
+                chunk = np.frombuffer(chunk,dtype=lev['dtype']).reshape(lev['chunks'])
+            else:
+                chunk = np.full(lev['chunks'],lev['fill'],dtype=lev['dtype'])
+            self.chunkCache.put(key,chunk)
+        return chunk
+        
+    def read(self,level,index):
+        # index = slices (step 1) of each dimension of the level; only intersecting chunks are decompressed
+        lev = self.levels[level]
+        bounds = [s.indices(n)[:2] for s,n in zip(index,lev['shape'])]
+        out = np.zeros([max(0,b-a) for a,b in bounds],dtype=lev['dtype'])
+        if out.size==0:
+            return out
+        chunkRanges = [range(a//c,(b-1)//c+1) for (a,b),c in zip(bounds,lev['chunks'])]
+        for chunkIndex in itertools.product(*chunkRanges):
+            src = []
+            dst = []
+            for i,(a,b),c in zip(chunkIndex,bounds,lev['chunks']):
+                start,stop = max(a,i*c),min(b,(i+1)*c)
+                src.append(slice(start-i*c,stop-i*c))
+                dst.append(slice(start-a,stop-a))
+            out[tuple(dst)] = self.getChunk(level,chunkIndex)[tuple(src)]
+        return out
+
+
+dataVersionCounter = itertools.count()
+tiffPagePool = TiffPagePool()
+
+def downsampleVolume(data,axis,chunkSize=16):
+    # average 2x2 blocks in the two spatial axes other than axis; odd edges are averaged with themselves
+    inPlane = [a for a in range(3) if a!=axis]
+    shape = list(data.shape)
+    for a in inPlane:
+        shape[a] = (shape[a]+1)//2
+    out = np.empty(shape,dtype=data.dtype)
+    for i in range(0,data.shape[axis],chunkSize):
+        chunk = [slice(None)]*4
+        chunk[axis] = slice(i,i+chunkSize)
+        d = data[tuple(chunk)].astype(np.uint32)
+        for a in inPlane:
+            if d.shape[a]%2:
+                d = np.concatenate((d,d.take([-1],axis=a)),axis=a)
+            even,odd = [slice(None)]*4,[slice(None)]*4
+            even[a] = slice(0,None,2)
+            odd[a] = slice(1,None,2)
+            d = d[tuple(even)]+d[tuple(odd)]
+        d += 2
+        d //= 4
+        out[tuple(chunk)] = d
+    return out
+
+def isTiffPyramid(filePath,tiled=False):
+    # True if the first series of a tiff file has resolution levels (or tiled pages if tiled is True) that TiffPyramid can read
+    # other data types are scaled to uint8 over the whole image by the flat page reader, which regions read by tile cannot do
+    with tiffPagePool.openFile(filePath) as tif:
+        series = tif.series[0]
+        if series.axes not in ('YX','YXS','CYX') or series.dtype not in (np.uint8,np.uint16):
+            return False
+        return len(series.levels)>1 or (tiled and series.keyframe.is_tiled)
+
+def writeChunkedVolume(dirPath,slabs,shape,dtype,chunks=(64,64,64,1),pixelSize=None,compression=1):
+    # write a height x width x n x channels volume as a multiscale zarr (v2) group of zlib compressed chunks (see ChunkedVolume)
+    # slabs yields parts of the volume chunks[2] images deep (the last may be less) so the volume is never held in memory
+    # lower resolution levels are added until the volume fits in a few chunks
+    shapes = [tuple(shape)]
+    while len(shapes)<8 and max(shapes[-1][:3])>4*max(chunks[:3]):
+        shapes.append(tuple((n+1)//2 for n in shapes[-1][:3])+tuple(shape[3:]))
+    dtype = np.dtype(dtype)
+    os.makedirs(dirPath,exist_ok=True)
+    with open(os.path.join(dirPath,'.zgroup'),'w') as f:
+        json.dump({'zarr_format':2},f)
+    datasets = [{'path':str(level),'coordinateTransformations':[{'type':'scale','scale':[2**level]*3+[1]}]} for level in range(len(shapes))]
+    with open(os.path.join(dirPath,'.zattrs'),'w') as f:
+        json.dump({'multiscales':[{'axes':['y','x','z','c'],'datasets':datasets}],'pixelSize':pixelSize},f)
+    for level,levelShape in enumerate(shapes):
+        os.makedirs(os.path.join(dirPath,str(level)),exist_ok=True)
+        with open(os.path.join(dirPath,str(level),'.zarray'),'w') as f:
+            json.dump({'zarr_format':2,'shape':levelShape,'chunks':chunks,'dtype':dtype.str,'compressor':{'id':'zlib','level':compression},
+                       'fill_value':0,'order':'C','filters':None,'dimension_separator':'.'},f)
+    position = [0]*len(shapes)
+    pending = [None]*len(shapes)
+    def writeSlab(level,slab):
+        # slab is at most one chunk deep and starts at a chunk boundary
+        zChunk = position[level]//chunks[2]
+        for i in range(0,slab.shape[0],chunks[0]):
+            for j in range(0,slab.shape[1],chunks[1]):
+                for k in range(0,slab.shape[3],chunks[3]):
+                    chunk = np.zeros(chunks,dtype=dtype)
+                    d = slab[i:i+chunks[0],j:j+chunks[1],:,k:k+chunks[3]]
+                    chunk[:d.shape[0],:d.shape[1],:d.shape[2],:d.shape[3]] = d
+                    chunkName = '.'.join(str(n) for n in (i//chunks[0],j//chunks[1],zChunk,k//chunks[3]))
+                    with open(os.path.join(dirPath,str(level),chunkName),'wb') as f:
+                        f.write(zlib.compress(chunk.tobytes(),compression))
+        position[level] += slab.shape[2]
+        if level+1<len(shapes):
+            # average 2 x 2 x 2 blocks; odd edges are averaged with themselves
+            d = downsampleVolume(slab,2)
+            if d.shape[2]%2:
+                d = np.concatenate((d,d[:,:,-1:]),axis=2)
+            d = ((d[:,:,0::2].astype(np.uint32)+d[:,:,1::2]+1)//2).astype(dtype)
+            pending[level+1] = d if pending[level+1] is None else np.concatenate((pending[level+1],d),axis=2)
+            if pending[level+1].shape[2]>=chunks[2]:
+                writeSlab(level+1,pending[level+1][:,:,:chunks[2]])
+                pending[level+1] = pending[level+1][:,:,chunks[2]:] if pending[level+1].shape[2]>chunks[2] else None
+    for slab in slabs:
+        writeSlab(0,np.asarray(slab,dtype=dtype))
+    for level in range(1,len(shapes)):
+        if pending[level] is not None:
+            d,pending[level] = pending[level],None
+            writeSlab(level,d)
+
 def getImageInfo(filePath):
     fileExt = os.path.splitext(filePath)[1][1:]
     if fileExt in ('tif','btf'):
@@ -3553,6 +4986,58 @@ def getImageInfo(filePath):
         img.close()
     return dtype,shape,numCh
 
+def getImageInfoList(filePaths):
+    # getImageInfo for many files, read concurrently and cached in a json file in each directory keyed by file mtime and size
+    info = [None]*len(filePaths)
+    caches = {}
+    fileKeys = []
+    for i,f in enumerate(filePaths):
+        directory,fileName = os.path.split(os.path.abspath(f))
+        if directory not in caches:
+            cachePath = os.path.join(directory,'.imageinfo.cache.json')
+            try:
+                with open(cachePath,'r') as cacheFile:
+                    caches[directory] = json.load(cacheFile)
+            except (OSError,ValueError):
+                caches[directory] = {}
+        fileStat = os.stat(f)
+        fileKeys.append([fileStat.st_mtime,fileStat.st_size])
+        cached = caches[directory].get(fileName)
+        if cached is not None and cached[0]==fileKeys[-1]:
+            dtype,shape,numCh = cached[1:]
+            info[i] = (getattr(np,dtype),tuple(shape),numCh)
+    missing = [i for i,fileInfo in enumerate(info) if fileInfo is None]
+    if len(missing)>0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32,4*os.cpu_count())) as pool:
+            for i,fileInfo in zip(missing,pool.map(getImageInfo,[filePaths[i] for i in missing])):
+                info[i] = fileInfo
+                directory,fileName = os.path.split(os.path.abspath(filePaths[i]))
+                caches[directory][fileName] = [fileKeys[i],fileInfo[0].__name__,[int(n) for n in fileInfo[1]],int(fileInfo[2])]
+        for directory in set(os.path.dirname(os.path.abspath(filePaths[i])) for i in missing):
+            try:
+                with open(os.path.join(directory,'.imageinfo.cache.json'),'w') as cacheFile:
+                    json.dump(caches[directory],cacheFile)
+            except OSError:
+                pass
+    return info
+
+def getNrrdDtype(header):
+    # numpy dtype of the data in a nrrd file from the type and endian fields of its header
+    nrrdTypes = {'i1':('signed char','int8','int8_t'),
+                 'u1':('uchar','unsigned char','uint8','uint8_t'),
+                 'i2':('short','short int','signed short','signed short int','int16','int16_t'),
+                 'u2':('ushort','unsigned short','unsigned short int','uint16','uint16_t'),
+                 'i4':('int','signed int','int32','int32_t'),
+                 'u4':('uint','unsigned int','uint32','uint32_t'),
+                 'i8':('longlong','long long','long long int','signed long long','signed long long int','int64','int64_t'),
+                 'u8':('ulonglong','unsigned long long','unsigned long long int','uint64','uint64_t'),
+                 'f4':('float',),
+                 'f8':('double',)}
+    for code,names in nrrdTypes.items():
+        if header['type'] in names:
+            return np.dtype(('>' if header.get('endian')=='big' else '<')+code)
+    raise ValueError('Unsupported nrrd type '+header['type'])
+    
 def getImageData(filePath,memmap=False):
     fileExt = os.path.splitext(filePath)[1][1:]
     if fileExt in ('tif','btf'):
@@ -3568,19 +5053,178 @@ def getImageData(filePath,memmap=False):
             data = data[:,:,::-1]
     return data
     
-def applyLUT(data,levels,binary=False,gamma=1):
-    dtype,maxVal = (np.uint8,2**8-1) if binary or data.dtype==np.uint8 else (np.uint16,2**16-1)
+def makeLUT(size,levels,levelsMax,gamma=1,binary=False):
+    # lookup table mapping raw intensities (0 to size-1) to display values
     if binary:
-        levels = [levels[1]-1,levels]
-    lut = np.arange(maxVal+1)
-    lut.clip(levels[0],levels[1],out=lut)
-    lut -= levels[0]
-    lut /= (levels[1]-levels[0])/maxVal
-    if gamma!=1 and not binary:
-        lut /= maxVal
+        lut = np.zeros(size,dtype=np.uint8)
+        lut[int(math.ceil(levels[1])):] = 255
+        return lut
+    lut = np.arange(size,dtype=float)
+    if levels[0]>0 or levels[1]<levelsMax:
+        lut.clip(levels[0],levels[1],out=lut)
+        lut -= levels[0]
+        lut /= (levels[1]-levels[0])/levelsMax
+    if gamma!=1:
+        lut /= levelsMax
         lut **= gamma
-        lut *= maxVal
-    return np.take(lut.astype(dtype),data)
+        lut *= levelsMax
+    lut.clip(0,levelsMax,out=lut)
+    return lut.astype(np.uint8 if levelsMax==255 else np.uint16)
+
+def applyLUT(data,levels,binary=False,gamma=1):
+    levelsMax = 2**8-1 if data.dtype==np.uint8 else 2**16-1
+    return np.take(makeLUT(levelsMax+1,levels,levelsMax,gamma,binary),data,mode='clip')
+    
+def getPasteSlices(start,n,size):
+    # destination and source slices for pasting n elements at start along an axis of length size
+    a = max(0,-start)
+    b = max(a,min(n,size-start))
+    return slice(start+a,start+b),slice(a,b)
+    
+def getRotationTransform(shape,angle,axes,transform=None):
+    # (matrix,offset,output shape) mapping output to input coordinates for scipy.ndimage.rotate(data,angle,axes) with reshape=True
+    # if transform is given, the rotation is applied to its output
+    axes = sorted(axes)
+    c,s = math.cos(math.radians(angle)),math.sin(math.radians(angle))
+    rotMatrix = np.array([[c,s],[-s,c]])
+    inPlaneShape = np.array([shape[i] for i in axes])
+    iy,ix = inPlaneShape
+    outBounds = rotMatrix.dot([[0,0,iy,iy],[0,ix,0,ix]])
+    outPlaneShape = (np.ptp(outBounds,axis=1)+0.5).astype(int)
+    matrix = np.eye(3)
+    matrix[np.ix_(axes,axes)] = rotMatrix
+    offset = np.zeros(3)
+    offset[axes] = (inPlaneShape-1)/2-rotMatrix.dot((outPlaneShape-1)/2)
+    outShape = list(shape[:3])
+    for i,n in zip(axes,outPlaneShape):
+        outShape[i] = int(n)
+    if transform is not None:
+        matrix,offset = transform[0].dot(matrix),transform[0].dot(offset)+transform[1]
+    return matrix,offset,tuple(outShape)
+    
+def rotateVolume(data,angle,axes,memmap=False,progress=None,chunkSize=8):
+    # same result shape as scipy.ndimage.rotate(data,angle,axes) with bicubic interpolation
+    # planes parallel to axes are rotated with cv2.warpAffine in chunks on a thread pool and written into a preallocated output
+    # progress(fraction done) is called on this thread and returns False to cancel, in which case None is returned
+    axes = sorted(axes)
+    matrix,offset,shape = getRotationTransform(data.shape,angle,axes)
+    shape += data.shape[3:]
+    if memmap:
+        output = np.memmap(tempfile.TemporaryFile(),dtype=data.dtype,mode='w+',shape=shape)
+    else:
+        output = np.zeros(shape,dtype=data.dtype)
+    # inverse map from output (col,row) to input (col,row) for the plane axes
+    r = matrix[np.ix_(axes,axes)]
+    warpMatrix = np.array([[r[1,1],r[1,0],offset[axes[1]]],[r[0,1],r[0,0],offset[axes[0]]]])
+    dsize = (shape[axes[1]],shape[axes[0]])
+    sliceAxis = [i for i in range(3) if i not in axes][0]
+    def rotateChunk(start):
+        for i in range(start,min(start+chunkSize,data.shape[sliceAxis])):
+            for ch in np.ndindex(data.shape[3:]):
+                ind = [slice(None)]*3+list(ch)
+                ind[sliceAxis] = i
+                ind = tuple(ind)
+                output[ind] = cv2.warpAffine(np.ascontiguousarray(data[ind]),warpMatrix,dsize,flags=cv2.INTER_CUBIC | cv2.WARP_INVERSE_MAP,borderMode=cv2.BORDER_CONSTANT,borderValue=0)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(rotateChunk,start) for start in range(0,data.shape[sliceAxis],chunkSize)]
+        for n,future in enumerate(concurrent.futures.as_completed(futures)):
+            future.result()
+            if progress is not None and not progress((n+1)/len(futures)):
+                for f in futures:
+                    f.cancel()
+                return None
+    return output
+    
+def rotateVolumes(volumes,rotations,memmap=None,progress=None):
+    # rotate each volume by each (angle,axes) in rotations in turn with rotateVolume
+    # returns the list of rotated volumes, or None if cancelled by progress so that nothing needs to be undone
+    # progress is called with the fraction done over all volumes and rotations
+    if memmap is None:
+        memmap = [False]*len(volumes)
+    rotated = list(volumes)
+    numSteps = len(rotations)*len(volumes)
+    for step,((angle,axes),i) in enumerate(itertools.product(rotations,range(len(volumes)))):
+        if progress is None:
+            stepProgress = None
+        else:
+            stepProgress = lambda fraction,step=step: progress((step+fraction)/numSteps)
+        data = rotateVolume(rotated[i],angle,axes,memmap[i],stepProgress)
+        if data is None:
+            return None
+        rotated[i] = data
+    return rotated
+    
+def rotatePoints(pts,angle,axes,inShape,outShape):
+    # rotate points (n x 3) in place with the volume (see rotateVolume) and return the image index of the rotated plane
+    # translate points such that origin is center of rotation , rotate, then translate back to image origin
+    # ynew = -x*sin(a) + y*cos(a)
+    # xnew = x*cos(a) + y*sin(a)
+    a = math.radians(angle)
+    if 0 not in axes:
+        a *= -1
+    center = [(inShape[i]-1)/2 for i in axes]
+    p = pts[:,axes]-center
+    c = [(outShape[i]-1)/2 for i in axes]
+    pts[:,axes[0]] = -p[:,1]*math.sin(a)+p[:,0]*math.cos(a)+c[0]
+    pts[:,axes[1]] = np.mean(p[:,1]*math.cos(a)+p[:,0]*math.sin(a)+c[1])
+    return int(round(pts[0,axes[1]]))
+    
+def sampleTransformed(data,transform,index,order=0,maxAxis=None):
+    # data[index] of the transformed volume, interpolating only the indexed points
+    # points are sampled one plane at a time so that coordinates are never computed for the whole index at once
+    # if maxAxis is given, the max projection along maxAxis is returned
+    matrix,offset,shape = transform
+    grid = [np.arange(n)[ind] if isinstance(ind,slice) else np.array([ind]) for ind,n in zip(index,shape)]
+    planeAxis = int(np.argmin([g.size for g in grid])) if maxAxis is None else maxAxis
+    outShape = [g.size for g in grid]
+    if maxAxis is not None:
+        outShape[maxAxis] = 1
+    out = np.zeros(outShape,dtype=data.dtype)
+    for n,i in enumerate(grid[planeAxis]):
+        planeGrid = [np.array([i]) if j==planeAxis else g for j,g in enumerate(grid)]
+        planeGrid = [g.reshape([-1 if k==j else 1 for k in range(3)]) for j,g in enumerate(planeGrid)]
+        planeShape = np.broadcast(*planeGrid).shape
+        coords = np.array([np.broadcast_to(sum(matrix[k,j]*planeGrid[j] for j in range(3))+offset[k],planeShape) for k in range(3)])
+        sample = scipy.ndimage.map_coordinates(data,coords,order=order)
+        outIndex = [slice(None)]*3
+        outIndex[planeAxis] = slice(0,1) if maxAxis is not None else slice(n,n+1)
+        outPlane = out[tuple(outIndex)]
+        if maxAxis is not None and n>0:
+            np.maximum(outPlane,sample,out=outPlane)
+        else:
+            outPlane[...] = sample
+    if maxAxis is not None:
+        index = [0 if j==maxAxis else ind for j,ind in enumerate(index)]
+    return out[tuple(slice(None) if isinstance(ind,slice) else 0 for ind in index)]
+    
+def getContourPath(contours,offset=(0,0)):
+    # one painter path of closed polygons from opencv contours; vertices are at pixel centers
+    if len(contours)==0:
+        return QtGui.QPainterPath()
+    pts = np.concatenate([np.concatenate((c[:,0],c[:1,0])) for c in contours]).astype(float)+np.add(offset,0.5)
+    connect = np.ones(pts.shape[0],dtype=np.int32)
+    connect[np.cumsum([c.shape[0]+1 for c in contours])-1] = 0
+    return pg.arrayToQPath(pts[:,0],pts[:,1],connect)
+    
+def drawPathItem(image,item,maxValue):
+    # burn a visible path item drawn over an image item (vertices at pixel centers, see getContourPath) into image
+    path = item.path()
+    if not item.isVisible() or path.isEmpty():
+        return
+    polygons = [np.array([[p.x()-0.5,p.y()-0.5] for p in polygon]).round().astype(np.int32) for polygon in path.toSubpathPolygons()]
+    color = tuple(maxValue*c/255 for c in item.pen().color().getRgb()[:3])
+    if item.brush().style()!=QtCore.Qt.NoBrush:
+        cv2.fillPoly(image,polygons,color)
+    cv2.polylines(image,polygons,False,color,1,cv2.LINE_AA)
+    
+def getLabelIndex(labels,chunkSize=16):
+    # dense uint16 indices of annotation labels (ids[index]==labels), computed in chunks along the last axis
+    chunks = [slice(i,i+chunkSize) for i in range(0,labels.shape[2],chunkSize)]
+    ids = np.unique(np.concatenate([[0]]+[np.unique(labels[:,:,s]) for s in chunks]))
+    index = np.empty(labels.shape,dtype=np.uint16)
+    for s in chunks:
+        index[:,:,s] = np.searchsorted(ids,labels[:,:,s])
+    return index,ids
     
 def getDelauneyBoundaryPoints(w,h):
     return [(0,0),(w/2,0),(w-1,0),(w-1,h/2),(w-1,h-1),(w/2,h-1),(0,h-1),(0,h/2)]
@@ -0,0 +1,348 @@
+import json, os, types
+import numpy as np
+import pytest
+import scipy.ndimage
+
+pytest.importorskip('PyQt5')
+ImageGui = pytest.importorskip('ImageGui')
+
+
+imageDataType = 'Image Data (*.tif *.btf *.png *.jpg *.jp2 *.npy *.npz *.nrrd *.nii)'
+
+
+def makeImageObj(data):
+    return ImageGui.ImageObj(data,None,None,None,True,False,False)
+
+
+def getRawPlane(imageObj,downsample=1,gui=None):
+    # getRawImageData only uses pyramidState and buildPyramidLevel of the gui
+    if gui is None:
+        gui = types.SimpleNamespace(pyramidState=True,buildPyramidLevel=lambda *args: None)
+    index = [slice(0,n) for n in imageObj.shape[:3]]
+    return ImageGui.ImageGui.getRawImageData(gui,imageObj,2,False,list(range(imageObj.shape[3])),downsample,index)
+
+
+def test_queued_oblique_rotations_are_composed():
+    data = np.random.default_rng(0).integers(0,255,(20,30,10,1),dtype=np.uint8)
+    imageObj = makeImageObj(data.copy())
+    source = imageObj.sourceData
+    imageObj.setObliqueRotation(30,(0,1))
+    imageObj.setObliqueRotation(-20,(0,2))
+    # the volume is not resampled until the rotation is applied
+    assert imageObj.sourceData is source
+    assert np.array_equal(imageObj.sourceData,data)
+    first = ImageGui.getRotationTransform(data.shape,30,(0,1))
+    matrix,offset,shape = ImageGui.getRotationTransform(first[2]+(1,),-20,(0,2),first)
+    assert np.allclose(imageObj.obliqueTransform[0],matrix)
+    assert np.allclose(imageObj.obliqueTransform[1],offset)
+    assert imageObj.shape==shape+(1,)
+    index = tuple(slice(0,n) for n in shape)
+    expected = ImageGui.sampleTransformed(data[:,:,:,0],(matrix,offset,shape),index,order=1)
+    for axis in range(3):
+        assert np.array_equal(imageObj.getObliqueData(index,[0],axis)[...,0],expected.max(axis=axis))
+    # applying the rotation gives the same result as rotating without deferral
+    expected = ImageGui.rotateVolume(ImageGui.rotateVolume(data,30,(0,1)),-20,(0,2))
+    assert np.array_equal(imageObj.data,expected)
+    assert imageObj.obliqueTransform is None and imageObj.shape==expected.shape
+
+
+def test_sample_transformed_by_plane():
+    data = np.random.default_rng(8).random((20,25,30)).astype(np.float32)
+    transform = ImageGui.getRotationTransform(data.shape,25,(0,2))
+    shape = transform[2]
+    full = scipy.ndimage.affine_transform(data,transform[0],transform[1],shape,order=1)
+    index = (slice(0,shape[0],2),slice(3,20),7)
+    assert np.allclose(ImageGui.sampleTransformed(data,transform,index,order=1),full[index],atol=1e-5)
+    index = (slice(None),slice(None),slice(4,12))
+    assert np.allclose(ImageGui.sampleTransformed(data,transform,index,order=1,maxAxis=2),full[index].max(axis=2),atol=1e-5)
+
+
+def test_cancelled_rotation_returns_none_and_keeps_volumes():
+    rng = np.random.default_rng(1)
+    volumes = [rng.integers(0,255,(20,30,10,1),dtype=np.uint8) for _ in range(2)]
+    originals = [v.copy() for v in volumes]
+    rotations = [(15,(0,1)),(-10,(0,2))]
+    calls = []
+    def progress(fraction):
+        # cancel while the second volume is being rotated by the first angle
+        calls.append(fraction)
+        return len(calls)<3
+    assert ImageGui.rotateVolumes(volumes,rotations,progress=progress) is None
+    for v,original in zip(volumes,originals):
+        assert np.array_equal(v,original)
+    rotated = ImageGui.rotateVolumes(volumes,rotations)
+    for v,r in zip(volumes,rotated):
+        expected = ImageGui.rotateVolume(ImageGui.rotateVolume(v,*rotations[0]),*rotations[1])
+        assert np.array_equal(r,expected)
+    # progress is reported once over all volumes and rotations
+    calls = []
+    ImageGui.rotateVolumes(volumes,rotations,progress=lambda fraction: calls.append(fraction) or True)
+    assert np.all(np.diff(calls)>0)
+    assert calls[-1]==pytest.approx(1)
+    assert all(any(c==pytest.approx(k/4) for c in calls) for k in (1,2,3))
+
+
+
+@pytest.mark.parametrize('dtype',[np.float32,np.int16,np.uint16])
+def test_lazy_tiled_tiff_reads_match_image_dtype(tmp_path,dtype):
+    tifffile = pytest.importorskip('tifffile')
+    data = (np.random.default_rng(2).random((300,400))*1000).astype(dtype)
+    filePath = str(tmp_path/'tiled.tif')
+    tifffile.imwrite(filePath,data,tile=(64,64))
+    imageObj = ImageGui.ImageObj(filePath,imageDataType,None,None,False,False,False)
+    assert (imageObj.fileType=='tiffPyramid')==(dtype==np.uint16)
+    plane = getRawPlane(imageObj,downsample=2)
+    assert plane.dtype==imageObj.dtype
+    assert plane.shape==(150,200,1)
+    if dtype==np.uint16:
+        assert np.array_equal(plane[:,:,0],data[::2,::2])
+
+
+@pytest.mark.parametrize('ext',['npy','npz'])
+def test_numpy_memmap_import(tmp_path,ext):
+    data = np.random.default_rng(3).integers(0,65535,(20,30,8,2),dtype=np.uint16)
+    filePath = str(tmp_path/('data.'+ext))
+    if ext=='npy':
+        np.save(filePath,data)
+    else:
+        np.savez(filePath,data)
+    imageObj = ImageGui.ImageObj(filePath,imageDataType,None,None,True,True,False)
+    assert imageObj.shape==(20,30,8,2)
+    assert isinstance(imageObj.data,np.memmap)
+    assert np.array_equal(imageObj.data,data)
+    # copy on write so that edits do not change the file
+    imageObj.data[0,0,0,0] = data[0,0,0,0]+1
+    assert np.array_equal(imageObj.getNumpyArray(),data)
+    lazyObj = ImageGui.ImageObj(filePath,imageDataType,None,None,False,True,False)
+    assert np.array_equal(lazyObj.getData([1],slice(2,5)),data[:,:,2:5,[1]])
+
+
+def test_lazy_numpy_slices_are_scaled_to_the_whole_array(tmp_path,monkeypatch):
+    data = np.random.default_rng(9).random((20,30,8,1)).astype(np.float32)*1000
+    data[:,:,6] *= 2
+    filePath = str(tmp_path/'data.npy')
+    np.save(filePath,data)
+    imageObj = ImageGui.ImageObj(filePath,imageDataType,None,None,False,True,False)
+    expected = imageObj.formatData(data)
+    assert np.array_equal(imageObj.getData(rangeSlice=slice(2,5)),expected[:,:,2:5])
+    # the scale factor is computed once rather than from the whole array for every read
+    calls = []
+    nanmax = np.nanmax
+    monkeypatch.setattr(np,'nanmax',lambda a,*args,**kwargs: calls.append(a.size) or nanmax(a,*args,**kwargs))
+    assert np.array_equal(imageObj.getData(rangeSlice=slice(0,1)),expected[:,:,:1])
+    assert calls==[]
+
+
+def test_tiff_page_pool_does_not_close_files_being_read(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    paths = [str(tmp_path/(str(i)+'.tif')) for i in range(2)]
+    data = [np.full((10,10),i+1,dtype=np.uint8) for i in range(2)]
+    for p,d in zip(paths,data):
+        tifffile.imwrite(p,d)
+    pool = ImageGui.TiffPagePool(maxFiles=1)
+    with pool.openFile(paths[0]) as tif:
+        # evicts the first file while it is being read
+        assert np.array_equal(pool.getPage(paths[1],0),data[1])
+        assert paths[0] not in pool.files
+        assert np.array_equal(tif.pages[0].asarray(),data[0])
+    assert tif.filehandle.closed
+    assert np.array_equal(pool.getPage(paths[0],0),data[0])
+    pool.closeAll()
+
+
+def writeChunked(dirPath,data,chunks=(16,16,16,1)):
+    slabs = (data[:,:,z:z+chunks[2]] for z in range(0,data.shape[2],chunks[2]))
+    ImageGui.writeChunkedVolume(dirPath,slabs,data.shape,data.dtype,chunks)
+
+
+@pytest.mark.parametrize('dtype',[np.float32,np.int16,np.uint8])
+def test_lazy_chunked_reads_match_image_dtype(tmp_path,dtype):
+    data = (np.random.default_rng(4).random((40,50,20,1))*1000).astype(dtype)
+    dirPath = str(tmp_path/'volume.zarr')
+    writeChunked(dirPath,data)
+    imageObj = ImageGui.ImageObj(dirPath,'Chunked Volume (*.zarr)',None,None,False,False,False)
+    assert imageObj.shape==data.shape
+    plane = getRawPlane(imageObj)
+    assert plane.dtype==imageObj.dtype
+    assert plane.shape==(40,50,1)
+    if dtype==np.uint8:
+        assert np.array_equal(plane,data.max(axis=2))
+
+
+def test_unsupported_zarr_compressor(tmp_path):
+    dirPath = str(tmp_path/'volume.zarr')
+    writeChunked(dirPath,np.zeros((20,20,20,1),dtype=np.uint8))
+    arrayPath = os.path.join(dirPath,'0','.zarray')
+    with open(arrayPath,'r') as f:
+        zarray = json.load(f)
+    zarray['compressor'] = {'id':'blosc','cname':'lz4','clevel':5,'shuffle':1}
+    with open(arrayPath,'w') as f:
+        json.dump(zarray,f)
+    with pytest.raises(ValueError,match='Unsupported zarr'):
+        ImageGui.ChunkedVolume(dirPath)
+
+
+def test_chunked_volume_must_be_4d(tmp_path):
+    dirPath = str(tmp_path/'volume.zarr')
+    writeChunked(dirPath,np.zeros((20,20,20,1),dtype=np.uint8))
+    arrayPath = os.path.join(dirPath,'0','.zarray')
+    with open(arrayPath,'r') as f:
+        zarray = json.load(f)
+    zarray['shape'] = zarray['shape'][:3]
+    zarray['chunks'] = zarray['chunks'][:3]
+    with open(arrayPath,'w') as f:
+        json.dump(zarray,f)
+    with pytest.raises(ValueError,match='4D'):
+        ImageGui.ImageObj(dirPath,'Chunked Volume (*.zarr)',None,None,False,False,False)
+
+
+@pytest.mark.parametrize('dtype',['<u2','>u2','<i2','<f4'])
+def test_nrrd_header_shape_and_dtype(tmp_path,dtype):
+    nrrd = pytest.importorskip('nrrd')
+    data = (np.random.default_rng(5).random((6,20,30))*1000).astype(dtype)
+    filePath = str(tmp_path/'volume.nrrd')
+    nrrd.write(filePath,data,{'encoding':'raw','endian':'big' if dtype[0]=='>' else 'little','spacings':[3,1,2]})
+    header = nrrd.read_header(filePath)
+    assert ImageGui.getNrrdDtype(header)==np.dtype(dtype)
+    imageObj = ImageGui.ImageObj(filePath,imageDataType,None,None,False,False,False)
+    assert imageObj.shape==(20,30,6,1)
+    assert all(type(n) is int for n in imageObj.shape)
+    json.dumps(imageObj.shape)
+    assert imageObj.pixelSize==[1,2,3]
+    assert imageObj.dtype==(np.uint16 if dtype[1:]=='u2' else np.uint8)
+    if imageObj.dtype==np.uint16:
+        assert np.array_equal(imageObj.getData(rangeSlice=slice(1,3))[:,:,:,0],data[1:3].transpose((1,2,0)))
+
+
+@pytest.mark.parametrize('units,pixelSize',[('mm',[1000,2000,3000]),('micron',[1,2,3]),('unknown',[1000,2000,3000])])
+def test_nifti_pixel_size_in_microns(tmp_path,units,pixelSize):
+    nibabel = pytest.importorskip('nibabel')
+    data = np.random.default_rng(8).integers(0,255,(6,20,30),dtype=np.uint8)
+    img = nibabel.Nifti1Image(data,np.diag([3,1,2,1]))
+    img.header.set_zooms((3,1,2))
+    img.header.set_xyzt_units(units)
+    filePath = str(tmp_path/'volume.nii')
+    nibabel.save(img,filePath)
+    imageObj = ImageGui.ImageObj(filePath,imageDataType,None,None,False,False,False)
+    assert imageObj.shape==(20,30,6,1)
+    assert imageObj.pixelSize==pixelSize
+
+
+def test_pyramid_level_is_built_off_the_display_path():
+    data = np.random.default_rng(6).integers(0,255,(40,60,5,1),dtype=np.uint8)
+    imageObj = makeImageObj(data)
+    requested = []
+    gui = types.SimpleNamespace(pyramidState=True,buildPyramidLevel=lambda *args: requested.append(args))
+    # strided full resolution data are shown until the averaged level is ready
+    assert np.array_equal(getRawPlane(imageObj,2,gui),data.max(axis=2)[::2,::2])
+    assert requested==[(imageObj,2,2)]
+    version = imageObj.dataVersion
+    level = imageObj.getPyramidLevel(2,2)
+    assert imageObj.isPyramidLevelReady(2,2)
+    assert imageObj.dataVersion!=version
+    assert np.array_equal(getRawPlane(imageObj,2,gui),level.max(axis=2))
+    assert len(requested)==1
+    # data edits discard built levels
+    imageObj.dataModified()
+    assert not imageObj.isPyramidLevelReady(2,2)
+
+
+def test_tiff_pyramid_histogram_uses_coarse_level(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    data = np.random.default_rng(7).integers(0,255,(4096,4096),dtype=np.uint8)
+    filePath = str(tmp_path/'pyramid.tif')
+    with tifffile.TiffWriter(filePath) as tif:
+        tif.write(data,subifds=2,tile=(256,256))
+        for factor in (2,4):
+            tif.write(data[::factor,::factor],subfiletype=1,tile=(256,256))
+    imageObj = ImageGui.ImageObj(filePath,imageDataType,None,None,True,False,False)
+    assert imageObj.fileType=='tiffPyramid' and imageObj.data is None
+    levels = []
+    read = imageObj.tiffPyramid.read
+    imageObj.tiffPyramid.read = lambda level,*args: levels.append(level) or read(level,*args)
+    hist = imageObj.computeHistogram(0)
+    assert levels==[1]
+    assert hist.sum()==data.size
+    expected = np.bincount(data[::2,::2].ravel(),minlength=256)*4
+    assert np.array_equal(hist,expected)
+
+
+def test_draw_path_item_burns_contours_into_image():
+    from PyQt5 import QtGui, QtWidgets
+    contour = np.array([[[2,3]],[[8,3]],[[8,7]],[[2,7]]],dtype=np.int32)
+    item = QtWidgets.QGraphicsPathItem()
+    item.setPath(ImageGui.getContourPath([contour]))
+    item.setPen(QtGui.QPen(QtGui.QColor(255,0,0)))
+    image = np.zeros((10,12,3),dtype=np.float32)
+    ImageGui.drawPathItem(image,item,255)
+    assert image[3,2:9,0].min()>0 and image[7,2:9,0].min()>0
+    assert image[5,5].max()==0 and image[...,1:].max()==0
+    item.setBrush(QtGui.QBrush(QtGui.QColor(255,0,0)))
+    ImageGui.drawPathItem(image,item,255)
+    assert image[5,5,0]==255
+    item.setVisible(False)
+    image[:] = 0
+    ImageGui.drawPathItem(image,item,255)
+    assert image.max()==0
+
+
+@pytest.mark.parametrize('axis',[0,1,2])
+def test_range_max_index_matches_max(axis):
+    rng = np.random.default_rng(10)
+    data = rng.integers(0,65535,(13,11,37,2),dtype=np.uint16)
+    index = ImageGui.RangeMaxIndex(data,axis)
+    planes = np.moveaxis(data,axis,0)
+    for _ in range(100):
+        start = int(rng.integers(0,planes.shape[0]))
+        stop = int(rng.integers(start+1,planes.shape[0]+1))
+        assert np.array_equal(index.getMax(start,stop,[0,1]),planes[start:stop].max(axis=0))
+    crop = (slice(2,8),slice(1,5))
+    assert np.array_equal(index.getMax(3,9,[1],crop),planes[3:9][(slice(None),)+crop+([1],)].max(axis=0))
+
+
+def test_label_index_of_large_ids():
+    rng = np.random.default_rng(11)
+    # allen ccf ids exceed the uint16 range but there are fewer than 2**16 distinct labels
+    ids = np.concatenate(([0],np.unique(rng.integers(2**16,2**31,1000,dtype=np.uint32))))
+    labels = ids[rng.integers(0,len(ids),(20,30,40))]
+    index,labelIDs = ImageGui.getLabelIndex(labels,chunkSize=7)
+    assert index.dtype==np.uint16
+    assert labelIDs[0]==0
+    assert np.array_equal(labelIDs[index],labels)
+    # region masks are a boolean lookup table indexed by the label index
+    region = ids[1:10]
+    lut = np.isin(labelIDs,region)
+    assert np.array_equal(lut[index],np.isin(labels,region))
+
+
+def test_atlas_structure_tree_cache(tmp_path):
+    graph = {'msg':[{'id':997,'acronym':'root','name':'root','color_hex_triplet':'FFFFFF','children':[
+                {'id':8,'acronym':'grey','name':'Basic cell groups','parent_structure_id':997,'children':[
+                    {'id':315,'acronym':'Isocortex','name':'Isocortex','parent_structure_id':8,'children':[]},
+                    {'id':1089,'acronym':'HPF','name':'Hippocampal formation','parent_structure_id':8,'children':[]}]},
+                {'id':1009,'acronym':'fiber tracts','name':'fiber tracts','parent_structure_id':997,'children':[]}]}]}
+    filePath = str(tmp_path/'structure_graph.json')
+    with open(filePath,'w') as f:
+        json.dump(graph,f)
+    tree = ImageGui.AtlasStructureTree(filePath)
+    assert tree.order==[997,8,315,1089,1009]
+    assert tree.getRegionIDs('grey')==[8,315,1089]
+    assert tree.getRegionIDs('unknown')==[]
+    assert tree.paths[1089]==[997,8,1089]
+    assert os.path.isfile(filePath+'.cache.json')
+    # the cached tree is used until the structure file changes
+    cached = ImageGui.AtlasStructureTree(filePath)
+    assert cached.structures==tree.structures
+    assert cached.descendants==tree.descendants
+    with open(filePath+'.cache.json','r') as f:
+        cache = json.load(f)
+    cache['structures'][1][2] = 'cached'
+    with open(filePath+'.cache.json','w') as f:
+        json.dump(cache,f)
+    assert 'cached' in ImageGui.AtlasStructureTree(filePath).acronyms
+    graph['msg'][0]['children'].pop()
+    with open(filePath,'w') as f:
+        json.dump(graph,f)
+    tree = ImageGui.AtlasStructureTree(filePath)
+    assert 'cached' not in tree.acronyms
+    assert tree.order==[997,8,315,1089]